@@ -2,10 +2,20 @@
 
 import argparse
 import glob
+import json
 import os
-import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from zipfile import ZipFile
+
+from anonlinkclient.utils import generate_candidate_blocks_from_csv
+
+from utils.clk_blocking import (
+    BLOCKING_REPORT,
+    block_size_report,
+    write_blocking_report,
+    zip_blocked_files,
+)
+from utils.clk_stats import STATS_SUFFIX
 
 
 def parse_arguments():
@@ -23,39 +33,82 @@ def parse_arguments():
         default="output",
         help="Specify a folder containing clks. Default is 'output' folder",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of CLK files to block in parallel."
+        " Each worker holds one CLK file in memory."
+        " Default is the number of CPUs",
+    )
+    parser.add_argument(
+        "--report",
+        default=str(BLOCKING_REPORT),
+        help="Where to write the block size distribution report, used for tuning"
+        f" the blocking schema. Default is {BLOCKING_REPORT}",
+    )
     args = parser.parse_args()
     if not Path(args.schemafile).exists():
         parser.error("Unable to find schema file: " + args.schemafile)
     return args
 
 
+def find_clk_files(clkpath, report_path):
+    # the CLK files in clkpath, skipping the other JSON files that can be
+    # next to them: garble.py's metadata and popcount sidecars,
+    # and blocking reports (including ones earlier versions wrote there)
+    report_path = Path(report_path).resolve()
+    return [
+        clk
+        for clk in glob.glob(os.path.join(clkpath, "*.json"))
+        if not Path(clk).name.startswith("metadata")
+        and not clk.endswith(STATS_SUFFIX)
+        and Path(clk).name != BLOCKING_REPORT.name
+        and Path(clk).resolve() != report_path
+    ]
+
+
+def block_clk_file(clk_path, schema_file):
+    # equivalent to `anonlink block clk_path schema_file output`,
+    # but run in-process and returned as a string to be written to the zip,
+    # along with a summary of the block sizes
+    with open(clk_path, "r") as clk_fp, open(schema_file, "r") as schema_fp:
+        result = generate_candidate_blocks_from_csv(clk_fp, schema_fp)
+    return json.dumps(result, indent=4), block_size_report(result)
+
+
 def block_individuals(args):
-    os.makedirs("temp-data", exist_ok=True)
     os.makedirs("output", exist_ok=True)
     schema_file = Path(args.schemafile)
-    clk_files = glob.glob(os.path.join(args.clkpath, "*.json"))
-    blocked_files = []
-    for clk in clk_files:
-        clk_path = Path(clk)
-        temp_file = Path("temp-data", clk.split("/")[-1])
-        subprocess.run(
-            ["anonlink", "block", str(clk_path), str(schema_file), str(temp_file)],
-            check=True,
+    clk_files = find_clk_files(args.clkpath, args.report)
+    blocked_names = [str(Path("temp-data", Path(clk).name)) for clk in clk_files]
+    max_workers = max(min(args.workers or 1, len(clk_files)), 1)
+    reports = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # blocking results are written into the zip as soon as each one is
+        # ready (in CLK file order), rather than via temp files
+        results = executor.map(
+            block_clk_file, clk_files, [schema_file] * len(clk_files)
         )
-        blocked_files.append(temp_file)
-    return blocked_files
 
+        def blocked_files():
+            for clk, blocked_name, (blocks_json, report) in zip(
+                clk_files, blocked_names, results
+            ):
+                reports.append((Path(clk).name, report))
+                yield blocked_name, blocks_json
+
+        zip_blocked_files(blocked_files(), "output/garbled_blocked.zip")
 
-def zip_blocked_files(blocked_files):
-    with ZipFile("output/garbled_blocked.zip", "w") as garbled_zip:
-        for blocked_file in blocked_files:
-            garbled_zip.write(blocked_file)
+    with open(schema_file, "r") as schema_fp:
+        blocking_config = json.load(schema_fp)
+    write_blocking_report(reports, blocking_config, args.report)
+    return blocked_names
 
 
 def main():
     args = parse_arguments()
-    blocked_files = block_individuals(args)
-    zip_blocked_files(blocked_files)
+    block_individuals(args)
 
 
 if __name__ == "__main__":
@@ -4,14 +4,26 @@ import argparse
 import glob
 import json
 import os
-import subprocess
 import sys
 from datetime import datetime
 from pathlib import Path
 from zipfile import ZipFile
 
+from clkhash.schema import SchemaError
+from clkhash.validate_data import EntryError, FormatError
+
 from definitions import TIMESTAMP_FMT, TIMESTAMP_LEN
 from derive_subkey import derive_subkey
+from utils.clk_blocking import (
+    BLOCKING_REPORT,
+    LambdaFoldBlocker,
+    block_size_report,
+    is_incremental_schema,
+    write_blocking_report,
+    zip_blocked_files,
+)
+from utils.clk_hashing import ClkJsonWriter, generate_clks_for_schemas, load_schema
+from utils.clk_stats import STATS_SUFFIX, ClkStats, write_clk_stats
 
 
 def parse_arguments():
@@ -37,7 +49,25 @@ def parse_arguments():
         default="output",
         help="Specify an output directory. Default is output/",
     )
+    parser.add_argument(
+        "--blockschema",
+        help="Also block the CLKs while they are being hashed, using this"
+        " lambda-fold blocking schema, and write garbled_blocked.zip"
+        " to the output directory, with a block size report in"
+        " temp-data/blocking_report.json. Produces the same output as running"
+        " block.py afterwards, without reading the CLKs back in."
+        " eg. example-schema/blocking-schema/lambda.json",
+    )
     args = parser.parse_args()
+    if args.blockschema:
+        if not Path(args.blockschema).exists():
+            parser.error("Unable to find blocking schema file: " + args.blockschema)
+        with open(args.blockschema, "r") as block_schema_file:
+            if not is_incremental_schema(json.load(block_schema_file)):
+                parser.error(
+                    "--blockschema only supports lambda-fold schemas with input-clks,"
+                    " use block.py for other blocking schemas"
+                )
     if not Path(args.schemadir).exists():
         parser.error("Unable to find directory: " + args.schemadir)
     if not Path(args.secretfile).exists():
@@ -73,6 +103,57 @@ def validate_clks(clk_files, metadata_file):
         ), f"Expected {n_lines_expected} in {clk_file.name}, found {n_lines_actual}"
 
 
+def hash_pii(source_file, secret, schema_files, outputdir, blocking_config=None):
+    # equivalent to running `anonlink hash` once per schema, but done in a
+    # single in-process pass over the PII so that features shared between
+    # schemas (eg. name, DOB, sex) are only tokenized and hashed once,
+    # and the Bloom filters are still in memory for the popcount sidecar
+    # and, if requested, for blocking
+    writers = {}
+    clk_stats = {}
+    blockers = {}
+    for s in schema_files:
+        try:
+            _, schema = load_schema(s)
+        except SchemaError as e:
+            sys.exit(f"Invalid schema {s}: {e}")
+        name = os.path.basename(s)
+        writers[name] = ClkJsonWriter(Path(outputdir) / name)
+        clk_stats[name] = ClkStats(name, schema.l)
+        if blocking_config:
+            blockers[name] = LambdaFoldBlocker(blocking_config, schema.l)
+
+    try:
+        for chunk_clks in generate_clks_for_schemas(source_file, secret, schema_files):
+            for name, clks in chunk_clks.items():
+                clk_stats[name].update(clks)
+                writers[name].write(clks)
+                if name in blockers:
+                    blockers[name].update(clks)
+    except (EntryError, FormatError) as e:
+        sys.exit(f"Hashing failed: {e}")
+
+    for writer in writers.values():
+        writer.close()
+        print(f"CLK data written to {writer.path}")
+
+    if blockers:
+        blocked_zip = Path(outputdir) / "garbled_blocked.zip"
+        blocked_files = []
+        reports = []
+        for name, blocker in blockers.items():
+            result = blocker.result()
+            # same names inside the zip as block.py uses
+            blocked_files.append(
+                (str(Path("temp-data") / name), json.dumps(result, indent=4))
+            )
+            reports.append((name, block_size_report(result)))
+        zip_blocked_files(blocked_files, blocked_zip)
+        print("Blocked zip file created at: " + str(blocked_zip))
+        write_blocking_report(reports, blocking_config, BLOCKING_REPORT)
+    return clk_stats
+
+
 def garble_pii(args):
     secret_file = Path(args.secretfile)
 
@@ -122,7 +203,6 @@ def garble_pii(args):
     secret = validate_secret_file(secret_file)
     individuals_secret = derive_subkey(secret, "individuals")
 
-    clk_files = []
     schema = glob.glob(args.schemadir + "/*.json")
     for s in schema:
         with open(s, "r") as schema_file:
@@ -131,28 +211,39 @@ def garble_pii(args):
                 sys.exit(
                     "The following schema uses doubleHash, which is insecure: " + str(s)
                 )
-        output_file = Path(args.outputdir) / os.path.basename(s)
-        subprocess.run(
-            [
-                "anonlink",
-                "hash",
-                source_file,
-                individuals_secret,
-                str(s),
-                str(output_file),
-            ],
-            check=True,
-        )
-        clk_files.append(output_file)
+    blocking_config = None
+    if args.blockschema:
+        with open(args.blockschema, "r") as block_schema_file:
+            blocking_config = json.load(block_schema_file)
+    all_clk_stats = hash_pii(
+        source_file, individuals_secret, schema, args.outputdir, blocking_config
+    )
+
+    clk_files = []
+    stats_files = []
+    for s in schema:
+        clk_files.append(Path(args.outputdir) / os.path.basename(s))
+
+        clk_stats = all_clk_stats[os.path.basename(s)]
+        stats_file = Path(args.outputdir) / (Path(s).stem + STATS_SUFFIX)
+        write_clk_stats(clk_stats, stats_file)
+        stats_files.append(stats_file)
+        if clk_stats.is_saturated():
+            print(
+                f"WARNING: Bloom filters for {os.path.basename(s)} are saturated,"
+                f" see {stats_file.name} for the bit density histogram"
+            )
     validate_clks(clk_files, metadata_file)
-    return clk_files + [Path(f"output/{metadata_file_name}")]
+    return clk_files + stats_files + [Path(f"output/{metadata_file_name}")]
 
 
 def create_output_zip(clk_files, args):
     with ZipFile(os.path.join(args.outputdir, args.outputzip), "w") as garbled_zip:
         for output_file in clk_files:
             garbled_zip.write(output_file)
-            if "metadata" in output_file.name:
+            if "metadata" in output_file.name or output_file.name.endswith(
+                STATS_SUFFIX
+            ):
                 os.remove(output_file)
     print("Zip file created at: " + str(Path(args.outputdir) / args.outputzip))
 
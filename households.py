@@ -10,11 +10,20 @@ from datetime import datetime
 from pathlib import Path
 from zipfile import ZipFile
 
+import numpy as np
 import pandas as pd
 
 from definitions import TIMESTAMP_FMT
 from derive_subkey import derive_subkey
-from households.matching import get_household_matches
+from households.blocking import DEFAULT_BLOCK_WINDOW, BlockCap
+from households.checkpoint import Checkpoint
+from households.clustering import group_components
+from households.incremental import get_incremental_household_matches
+from households.matching import dump_matching_pairs, get_household_matches
+from households.memory import MemoryBudget, format_memory_size, parse_memory_size
+from households.partitioning import INFERENCE_COLUMNS, get_partitioned_household_matches
+from households.shards import export_shards, file_sha256, infer_shard, merge_shards
+from households.telemetry import Telemetry, household_size_distribution
 
 HEADERS = ["HOUSEHOLD_POSITION", "PII_POSITIONS"]
 HOUSEHOLD_PII_HEADERS = [
@@ -25,6 +34,7 @@ HOUSEHOLD_PII_HEADERS = [
     "record_ids",
 ]
 HOUSEHOLD_POS_PID_HEADERS = ["household_position", "pid"]
+DEFAULT_CHECKPOINT_DIR = "temp-data/households_checkpoint"
 
 
 def parse_arguments():
@@ -70,10 +80,19 @@ def parse_arguments():
     parser.add_argument(
         "--split_factor",
         type=int,
-        default=4,
-        help="Number of segments to split data into when inferring households."
-        " Smaller numbers may result in out of memory errors. Larger numbers"
-        " may increase runtime. Default is 4",
+        help="Number of segments to split data into when comparing candidate pairs"
+        " in detail. Smaller numbers may result in out of memory errors."
+        " Larger numbers may increase runtime. By default, the work is split into"
+        " chunks sized automatically to fit --max_memory",
+    )
+    parser.add_argument(
+        "--max_memory",
+        "--max-memory",
+        type=parse_memory_size,
+        help="Memory budget for inferring households, eg. 512M or 16G,"
+        " which blocking and comparison chunks are sized to fit."
+        " Shared between --workers with --partition_by_zip."
+        " Default is half the memory available at the start",
     )
     parser.add_argument(
         "--exact_addresses",
@@ -88,9 +107,106 @@ def parse_arguments():
         " will likely increase false negatives  (records not being included "
         " in households where they should be).",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes to use when inferring households."
+        " Default is the number of CPUs",
+    )
+    parser.add_argument(
+        "--max_block_size",
+        type=int,
+        help="Largest group of records sharing a blocking key (eg. a zip code and"
+        " family name) to compare all against all. Larger groups are sorted on"
+        " a secondary key, eg. address for a family name, and each record is"
+        " only compared with its --block_window nearest neighbours."
+        " Default is no limit",
+    )
+    parser.add_argument(
+        "--block_window",
+        type=int,
+        default=DEFAULT_BLOCK_WINDOW,
+        help="Window size for groups over --max_block_size."
+        f" Default is {DEFAULT_BLOCK_WINDOW}",
+    )
+    parser.add_argument(
+        "--address_lsh",
+        action="store_true",
+        help="Also compare records in the same zip code whose addresses are"
+        " similar (by MinHash LSH over pairs of characters), not just those"
+        " with the same street and number or family name. Finds households"
+        " with typos in the street or number, for more comparisons",
+    )
+    parser.add_argument(
+        "--partition_by_zip",
+        action="store_true",
+        help="Infer households separately for groups of zip codes, in parallel"
+        " across --workers processes. Households never span zip codes, so the"
+        " result is the same, but each process only holds its own zip codes."
+        " Not compatible with --pairsfile",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only compare records that are new or changed since the last run"
+        " with --incremental, reusing the matches between the others saved"
+        " in --state_dir, and save the matches of this run there."
+        " The households are the same as without it",
+    )
+    parser.add_argument(
+        "--state_dir",
+        default="temp-data/households_state",
+        help="Directory of saved matches for --incremental. It holds the parsed"
+        " addresses of every record, so protect it the same way as temp-data/."
+        " Default: temp-data/households_state",
+    )
+    parser.add_argument(
+        "--export_shards",
+        type=int,
+        metavar="N",
+        help="Split the source PII into N shards of whole zip codes in --shard_dir,"
+        " to infer households on separate hosts with --shard, then exit",
+    )
+    parser.add_argument(
+        "--shard",
+        type=int,
+        metavar="N",
+        help="Infer households for shard N of --shard_dir, as exported by"
+        " --export_shards, then exit. The source PII file is not needed",
+    )
+    parser.add_argument(
+        "--merge_shards",
+        action="store_true",
+        help="Use the households inferred for every shard in --shard_dir,"
+        " rather than inferring households from the source PII",
+    )
+    parser.add_argument(
+        "--shard_dir",
+        default="temp-data/households_shards",
+        help="Directory of shards for --export_shards, --shard and --merge_shards."
+        " Default: temp-data/households_shards",
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        help="Directory to save each stage of household inference to as it"
+        " completes, so a run that stops part way can be resumed with --resume."
+        " Removed once the households are written."
+        " No checkpoint is saved unless this or --resume is given",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume from the checkpoint in --checkpoint_dir, skipping the stages"
+        " and batches of comparisons it already has. It must be for the same PII"
+        " file and settings, otherwise inference starts over, saving a new one."
+        f" Default --checkpoint_dir: {DEFAULT_CHECKPOINT_DIR}",
+    )
     parser.add_argument(
         "--pairsfile",
-        help="Location of matching pairs file",
+        help="Location of matching pairs file, as written to temp-data"
+        " by a previous run with --debug. It must have been created from the same"
+        " PII file",
     )
     parser.add_argument(
         "--debug",
@@ -104,6 +220,65 @@ def parse_arguments():
         parser.error("Unable to find schema file: " + args.secretfile)
     if not Path(args.secretfile).exists():
         parser.error("Unable to find secret file: " + args.secretfile)
+    if args.split_factor is not None and args.max_memory is not None:
+        parser.error("--split_factor can't be used with --max_memory")
+    if args.max_block_size is not None and args.max_block_size < 2:
+        parser.error("--max_block_size must be at least 2")
+    if args.block_window < 2:
+        parser.error("--block_window must be at least 2")
+    if args.address_lsh and args.exact_addresses:
+        parser.error("--address_lsh can't be used with --exact_addresses")
+    if args.max_block_size is not None and args.exact_addresses:
+        # exact households are grouped directly, without comparing any pairs
+        parser.error("--max_block_size can't be used with --exact_addresses")
+    if args.partition_by_zip and args.pairsfile:
+        parser.error("--partition_by_zip can't be used with --pairsfile")
+    if args.incremental and (
+        args.exact_addresses
+        or args.max_block_size is not None
+        or args.pairsfile
+        or args.partition_by_zip
+    ):
+        # with --max_block_size, whether two records are compared
+        # depends on the other records in their block
+        parser.error(
+            "--incremental can't be used with --exact_addresses, --max_block_size,"
+            " --pairsfile or --partition_by_zip"
+        )
+    if (args.resume or args.checkpoint_dir) and (
+        args.householddef
+        or args.exact_addresses
+        or args.pairsfile
+        or args.partition_by_zip
+        or args.incremental
+    ):
+        parser.error(
+            "--checkpoint_dir and --resume can't be used with --householddef,"
+            " --exact_addresses, --pairsfile, --partition_by_zip or --incremental"
+        )
+    if args.resume and args.checkpoint_dir is None:
+        args.checkpoint_dir = DEFAULT_CHECKPOINT_DIR
+    shard_steps = [
+        args.export_shards is not None,
+        args.shard is not None,
+        args.merge_shards,
+    ]
+    if sum(shard_steps) > 1:
+        parser.error("Use only one of --export_shards, --shard and --merge_shards")
+    if any(shard_steps) and (
+        args.householddef
+        or args.pairsfile
+        or args.partition_by_zip
+        or args.incremental
+        or args.checkpoint_dir
+    ):
+        parser.error(
+            "--export_shards, --shard and --merge_shards can't be used with"
+            " --householddef, --pairsfile, --partition_by_zip, --incremental,"
+            " --checkpoint_dir or --resume"
+        )
+    if args.export_shards is not None and args.export_shards < 1:
+        parser.error("--export_shards must be at least 1")
     return args
 
 
@@ -124,21 +299,21 @@ def parse_source_file(source_file, debug=False):
     if debug:
         print(f"[{datetime.now()}] Start loading PII file")
 
-    # dtype=str means force all columns to be strings even if they look numeric
+    # dtype=str means force all columns to be strings even if they look numeric,
+    #   and the columns household inference reads are categorical strings:
+    #   small integer codes per row, with each distinct value stored once
+    #   (family members share names, phones and addresses, and zips repeat a lot)
     # keep_default_na keeps empty cells as empty string, not a NaN
     # usecols means only read the given colummn names,
     #   aka don't read the columns that are never used here: given_name, DOB, sex
     df = pd.read_csv(
         source_file,
-        dtype=str,
+        dtype={
+            "record_id": str,
+            **{column: "category" for column in INFERENCE_COLUMNS},
+        },
         keep_default_na=False,
-        usecols=[
-            "record_id",
-            "family_name",
-            "phone_number",
-            "household_street_address",
-            "household_zip",
-        ],
+        usecols=["record_id", *INFERENCE_COLUMNS],
     )
 
     if debug:
@@ -147,28 +322,6 @@ def parse_source_file(source_file, debug=False):
     return df
 
 
-# Simple breadth-first-search to turn a graph-like structure of pairs
-# into a list representing the ids in the household
-def bfs_traverse_matches(pos_to_pairs, position):
-    queue = [position]
-    visited = [position]
-
-    while queue:
-        curr = queue.pop(0)
-        pairs = pos_to_pairs[curr]
-
-        for p in pairs:
-            if p[0] not in visited:
-                visited.append(p[0])
-                queue.append(p[0])
-            if p[1] not in visited:
-                visited.append(p[1])
-                queue.append(p[1])
-
-    visited.sort()
-    return visited
-
-
 def get_default_pii_csv(dirname="temp-data"):
     filenames = list(filter(lambda x: "pii" in x and len(x) == 23, os.listdir(dirname)))
     timestamps = [
@@ -179,103 +332,245 @@ def get_default_pii_csv(dirname="temp-data"):
     return source_file
 
 
-def write_pii_and_mapping_file(pos_pid_rows, hid_pat_id_rows, household_time, args):
+def get_pii_timestamp(source_file):
+    # the TIMESTAMP in pii-TIMESTAMP.csv
+    source_file_name = os.path.basename(source_file)
+    return os.path.splitext(source_file_name.replace("pii-", ""))[0]
+
+
+def load_source_file(args):
     if args.sourcefile:
         source_file = Path(args.sourcefile)
     else:
         source_file = get_default_pii_csv()
         print(f"PII Source: {str(source_file)}")
-    pii_lines = parse_source_file(source_file, args.debug)
+    return source_file, parse_source_file(source_file, args.debug)
 
-    # pos_to_pairs is a dict of:
-    # (patient position) --> [matching pairs that include that patient]
-    # so it can be traversed sort of like a graph from any given patient
-    # note the key is patient position within the pii_lines dataframe
-    pos_to_pairs = get_household_matches(
-        pii_lines, args.split_factor, args.debug, args.exact_addresses, args.pairsfile
+
+def get_memory_budget(args):
+    # None when --split_factor sets the chunk sizes
+    if args.split_factor is not None or args.pairsfile:
+        return None
+    memory_budget = MemoryBudget(args.max_memory)
+    print(
+        "Sizing household inference chunks to a memory budget of"
+        f" {format_memory_size(memory_budget.max_bytes)}"
+    )
+    return memory_budget
+
+
+def get_block_cap(args):
+    if args.max_block_size is None:
+        return None
+    return BlockCap(args.max_block_size, args.block_window)
+
+
+def get_checkpoint(args, source_file, pii_timestamp, n_rows):
+    # only with --checkpoint_dir or --resume, which can't be combined with
+    # a pairsfile or exact addresses (no stages to save) or the other modes
+    if args.checkpoint_dir is None:
+        return None
+    if args.debug:
+        print(f"[{datetime.now()}] Hashing PII file for the checkpoint")
+    # the settings that change which pairs match
+    settings = {
+        "address_lsh": args.address_lsh,
+        "max_block_size": args.max_block_size,
+        "block_window": args.block_window,
+    }
+    return Checkpoint(
+        args.checkpoint_dir,
+        file_sha256(source_file),
+        pii_timestamp,
+        n_rows,
+        settings,
+        args.resume,
+        args.debug,
     )
 
-    mapping_file = Path(args.mappingfile)
 
-    n_households = 0
-    with open(mapping_file, "w", newline="", encoding="utf-8") as csvfile:
+def write_pii_and_mapping_file(household_time, args):
+    telemetry = Telemetry(args.debug)
+    with telemetry.stage("load_pii") as metrics:
+        source_file, pii_lines = load_source_file(args)
+        metrics["rows"] = len(pii_lines)
+
+    # household_labels has one entry per row of pii_lines:
+    # the position of the first row in that row's household
+    pii_timestamp = get_pii_timestamp(source_file)
+    checkpoint = None
+    if args.merge_shards:
+        with telemetry.stage("merge_shards", rows=len(pii_lines)):
+            household_labels = merge_shards(
+                args.shard_dir, pii_timestamp, len(pii_lines), args.debug
+            )
+    elif args.partition_by_zip:
+        with telemetry.stage("partitioned_inference", rows=len(pii_lines)):
+            household_labels, matching_pairs = get_partitioned_household_matches(
+                pii_lines,
+                args.split_factor,
+                args.debug,
+                args.exact_addresses,
+                args.workers,
+                get_memory_budget(args),
+                get_block_cap(args),
+                args.address_lsh,
+            )
+        if args.debug:
+            dump_matching_pairs(matching_pairs, pii_timestamp, len(pii_lines))
+    elif args.incremental:
+        # records in the state are fingerprinted with the households secret
+        households_secret = derive_subkey(
+            validate_secret_file(args.secretfile), "households"
+        )
+        with telemetry.stage("incremental_inference", rows=len(pii_lines)):
+            household_labels, matching_pairs = get_incremental_household_matches(
+                pii_lines,
+                args.state_dir,
+                pii_timestamp,
+                households_secret,
+                args.split_factor,
+                args.debug,
+                args.workers,
+                get_memory_budget(args),
+                args.address_lsh,
+            )
+        if args.debug:
+            dump_matching_pairs(matching_pairs, pii_timestamp, len(pii_lines))
+    else:
+        checkpoint = get_checkpoint(args, source_file, pii_timestamp, len(pii_lines))
+        household_labels = get_household_matches(
+            pii_lines,
+            args.split_factor,
+            args.debug,
+            args.exact_addresses,
+            args.pairsfile,
+            args.workers,
+            pii_timestamp,
+            get_memory_budget(args),
+            get_block_cap(args),
+            args.address_lsh,
+            checkpoint,
+            telemetry,
+        )
+
+    with telemetry.stage("output", rows=len(pii_lines)) as metrics:
+        n_households = write_household_files(
+            pii_lines, household_labels, household_time, args
+        )
+        metrics["households"] = n_households
+    if checkpoint:
+        # the households are written, there is nothing left to resume
+        checkpoint.remove()
+
+    write_metrics(telemetry, household_labels, pii_timestamp, household_time, args)
+    return n_households
+
+
+def write_metrics(telemetry, household_labels, pii_timestamp, household_time, args):
+    # next to the mapping file. only counts, timings and settings, no PII
+    timestamp = household_time.strftime(TIMESTAMP_FMT)
+    metrics_path = (
+        Path(args.mappingfile).parent / f"households_metrics-{timestamp}.json"
+    )
+    settings = {
+        setting: getattr(args, setting)
+        for setting in [
+            "split_factor",
+            "max_memory",
+            "workers",
+            "exact_addresses",
+            "address_lsh",
+            "max_block_size",
+            "block_window",
+            "partition_by_zip",
+            "incremental",
+            "merge_shards",
+            "resume",
+        ]
+    }
+    settings["pairsfile"] = bool(args.pairsfile)
+    settings["checkpoint"] = args.checkpoint_dir is not None
+    telemetry.write(
+        metrics_path,
+        pii_timestamp=pii_timestamp,
+        pii_rows=len(household_labels),
+        settings=settings,
+        household_sizes=household_size_distribution(household_labels),
+    )
+    print(f"Wrote household inference metrics to {metrics_path}")
+
+
+def write_household_files(pii_lines, household_labels, household_time, args):
+    if args.debug:
+        print(f"[{datetime.now()}] Assembling output file")
+
+    # row positions of each household, sorted ascending,
+    # are order[starts[g]:starts[g + 1]] for group g.
+    # groups are sorted by label, ie. by the first position in the household
+    order, starts = group_components(household_labels)
+    sizes = np.diff(starts)
+    group_labels = household_labels[order[starts[:-1]]]
+
+    # shuffle all rows with a single permutation.
+    # households are numbered in the order their first row appears in the shuffle,
+    # and that row is the one whose PII represents the household
+    shuffled = np.random.permutation(len(pii_lines))
+    _, first_seen = np.unique(household_labels[shuffled], return_index=True)
+    first_seen.sort()
+    representatives = shuffled[first_seen]
+    # group (in label order) of each household (in output order)
+    household_groups = np.searchsorted(group_labels, household_labels[representatives])
+    n_households = len(representatives)
+
+    # comma-separated positions and record_ids of each group's members
+    group_ids = np.repeat(np.arange(len(sizes)), sizes)
+    positions_str = (
+        pd.Series(order.astype(str)).groupby(group_ids).agg(",".join).to_numpy()
+    )
+    record_ids = pii_lines["record_id"].to_numpy()
+    record_ids_str = (
+        pd.Series(record_ids[order]).groupby(group_ids).agg(",".join).to_numpy()
+    )
+
+    with open(args.mappingfile, "w", newline="", encoding="utf-8") as csvfile:
         mapping_writer = csv.writer(csvfile)
         mapping_writer.writerow(HEADERS)
+        mapping_writer.writerows(
+            zip(range(n_households), positions_str[household_groups])
+        )
 
-        if args.debug:
-            print(f"[{datetime.now()}] Assembling output file")
-
-        timestamp = household_time.strftime(TIMESTAMP_FMT)
-        hh_pii_path = Path("temp-data") / f"households_pii-{timestamp}.csv"
-        with open(
-            hh_pii_path,
-            "w",
-            newline="",
-            encoding="utf-8",
-        ) as hh_pii_csv:
-            print(f"Writing households PII to {hh_pii_path}")
-            pii_writer = csv.writer(hh_pii_csv)
-            pii_writer.writerow(HOUSEHOLD_PII_HEADERS)
-
-            pii_lines["written_to_file"] = False
-            hclk_position = 0
-            lines_processed = 0
-            hh_sizes = []
-            five_percent = int(len(pii_lines) / 20)
-            # Match households
-            for position, _line in pii_lines.sample(frac=1).iterrows():
-                # sample(frac=1) shuffles the entire dataframe
-                # note that "position" is the index and still relative to the original
-                line = pii_lines.loc[position]
-                lines_processed += 1
-
-                if args.debug and (lines_processed % five_percent) == 0:
-                    print(
-                        f"[{datetime.now()}]  Processing pii lines"
-                        f" - {lines_processed}/{len(pii_lines)}"
-                    )
-
-                if line["written_to_file"]:
-                    continue
-
-                if position in pos_to_pairs:
-                    pat_positions = bfs_traverse_matches(pos_to_pairs, position)
-                    # map those row numbers to PATIDs
-                    pat_ids = list(
-                        map(lambda p: pii_lines.at[p, "record_id"], pat_positions)
-                    )
-                else:
-                    pat_positions = [position]
-                    pat_ids = [line[0]]
-
-                # mark all these rows as written to file
-                pii_lines.loc[pat_positions, ["written_to_file"]] = True
-
-                hh_sizes.append(len(pat_positions))
-
-                string_pat_positions = [str(p) for p in pat_positions]
-                pat_string = ",".join(string_pat_positions)
-                mapping_writer.writerow([hclk_position, pat_string])
-                n_households += 1
-
-                if args.testrun:
-                    pos_pid_rows.append([hclk_position, line[0]])
-                    for patid in pat_ids:
-                        hid_pat_id_rows.append([hclk_position, patid])
-
-                # note pat_ids_str will be quoted by the csv writer if needed
-                pat_ids_str = ",".join(pat_ids)
-                output_row = [
-                    line["family_name"],
-                    line["phone_number"],
-                    line["household_street_address"],
-                    line["household_zip"],
-                    pat_ids_str,
-                ]
-                hclk_position += 1
-                pii_writer.writerow(output_row)
-
-    hh_sizes_series = pd.Series(hh_sizes, dtype=int)
+    timestamp = household_time.strftime(TIMESTAMP_FMT)
+    hh_pii_path = Path("temp-data") / f"households_pii-{timestamp}.csv"
+    print(f"Writing households PII to {hh_pii_path}")
+    with open(hh_pii_path, "w", newline="", encoding="utf-8") as hh_pii_csv:
+        pii_writer = csv.writer(hh_pii_csv)
+        pii_writer.writerow(HOUSEHOLD_PII_HEADERS)
+        # note the record_ids will be quoted by the csv writer if needed
+        pii_writer.writerows(
+            zip(
+                pii_lines["family_name"].to_numpy()[representatives],
+                pii_lines["phone_number"].to_numpy()[representatives],
+                pii_lines["household_street_address"].to_numpy()[representatives],
+                pii_lines["household_zip"].to_numpy()[representatives],
+                record_ids_str[household_groups],
+            )
+        )
+
+    if args.testrun:
+        write_hid_hh_pos_map(zip(range(n_households), record_ids[representatives]))
+
+        # one row per record, grouped by household in output order,
+        # in ascending position order within each household
+        household_of_group = np.empty(len(sizes), dtype=np.int64)
+        household_of_group[household_groups] = np.arange(n_households)
+        row_households = household_of_group[group_ids]
+        by_household = np.argsort(row_households, kind="stable")
+        write_scoring_file(
+            zip(row_households[by_household], record_ids[order][by_household])
+        )
+
+    hh_sizes_series = pd.Series(sizes, dtype=int)
 
     print("Household size stats:")
     print(hh_sizes_series.describe())
@@ -290,8 +585,7 @@ def write_scoring_file(hid_pat_id_rows):
     ) as hpos_pat_csv:
         writer = csv.writer(hpos_pat_csv)
         writer.writerow(HOUSEHOLD_POS_PID_HEADERS)
-        for output_row in hid_pat_id_rows:
-            writer.writerow(output_row)
+        writer.writerows(hid_pat_id_rows)
 
 
 def write_hid_hh_pos_map(pos_pid_rows):
@@ -301,8 +595,7 @@ def write_hid_hh_pos_map(pos_pid_rows):
     ) as house_pos_csv:
         writer = csv.writer(house_pos_csv)
         writer.writerow(HOUSEHOLD_POS_PID_HEADERS)
-        for output_row in pos_pid_rows:
-            writer.writerow(output_row)
+        writer.writerows(pos_pid_rows)
 
 
 def hash_households(args, household_time):
@@ -335,19 +628,37 @@ def hash_households(args, household_time):
 
 
 def infer_households(args, household_time):
-    pos_pid_rows = []
-    hid_pat_id_rows = []
     os.makedirs(Path("output") / "households", exist_ok=True)
     os.makedirs("temp-data", exist_ok=True)
-    n_households = write_pii_and_mapping_file(
-        pos_pid_rows, hid_pat_id_rows, household_time, args
-    )
-    if args.testrun:
-        write_scoring_file(hid_pat_id_rows)
-        write_hid_hh_pos_map(pos_pid_rows)
+    n_households = write_pii_and_mapping_file(household_time, args)
     return n_households
 
 
+def run_shard_step(args):
+    # the steps of a multi-host run that come before merging the shards
+    if args.shard is not None:
+        infer_shard(
+            args.shard_dir,
+            args.shard,
+            args.split_factor,
+            args.debug,
+            args.exact_addresses,
+            args.workers,
+            get_memory_budget(args),
+            get_block_cap(args),
+            args.address_lsh,
+        )
+    else:
+        source_file, pii_lines = load_source_file(args)
+        export_shards(
+            pii_lines,
+            args.shard_dir,
+            args.export_shards,
+            get_pii_timestamp(source_file),
+            args.debug,
+        )
+
+
 def create_output_zip(args, n_households, household_time):
 
     timestamp = household_time.strftime(TIMESTAMP_FMT)
@@ -360,7 +671,7 @@ def create_output_zip(args, n_households, household_time):
     source_file_name = os.path.basename(source_file)
     source_dir_name = os.path.dirname(source_file)
 
-    source_timestamp = os.path.splitext(source_file_name.replace("pii-", ""))[0]
+    source_timestamp = get_pii_timestamp(source_file)
     metadata_file_name = source_file_name.replace("pii", "metadata").replace(
         ".csv", ".json"
     )
@@ -400,6 +711,10 @@ def create_output_zip(args, n_households, household_time):
 
 def main():
     args = parse_arguments()
+    if args.export_shards is not None or args.shard is not None:
+        run_shard_step(args)
+        return
+
     household_time = datetime.now()
     if not args.householddef:
         n_households = infer_households(args, household_time)
@@ -0,0 +1,223 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from households.similarity import hamming_similarity, jaro_winkler
+
+# the columns explode_addresses adds for the parts of an address
+PARSED_COLUMNS = ["number", "street", "suffix", "prefix", "value"]
+# the components of an address compared by address_distance:
+# the address itself, and the parts it was parsed into
+ADDRESS_COLUMNS = ["household_street_address", *PARSED_COLUMNS]
+
+SIMILARITY_FUNCTIONS = {
+    "jaro_winkler": jaro_winkler,
+    "hamming_similarity": hamming_similarity,
+}
+
+# every (function, view of the first address, view of the second address)
+# compared by address_distance
+ADDRESS_COMPARISONS = [
+    ("hamming_similarity", "number", "number"),
+    ("jaro_winkler", "street", "street"),
+    ("jaro_winkler", "suffix", "suffix"),
+    ("jaro_winkler", "street_suffix", "street"),
+    ("jaro_winkler", "street_suffix", "suffix"),
+    ("jaro_winkler", "street", "suffix"),
+    ("jaro_winkler", "value", "value"),
+    ("jaro_winkler", "prefix", "prefix"),
+    ("jaro_winkler", "prefix_value", "value"),
+    ("jaro_winkler", "prefixvalue", "prefix"),
+    ("jaro_winkler", "value", "prefix"),
+    ("jaro_winkler", "prefixvalue", "prefixvalue"),
+    ("jaro_winkler", "household_street_address", "household_street_address"),
+]
+
+
+def address_view(addr, view, rows):
+    # the strings compared for one view of the addresses at rows,
+    # addr holds the ADDRESS_COLUMNS as arrays.
+    # a view is either one of those columns, or a combination of them
+    if view == "street_suffix":
+        return addr["street"][rows] + " " + addr["suffix"][rows]
+    if view == "prefix_value":
+        return addr["prefix"][rows] + " " + addr["value"][rows]
+    if view == "prefixvalue":
+        return addr["prefix"][rows] + addr["value"][rows]
+    return addr[view][rows]
+
+
+class AddressStrings:
+    """Compares views of the two addresses of each pair as strings,
+    through a SimilarityCache.
+    addr1 and addr2 hold the ADDRESS_COLUMNS of each side, one row per pair
+    """
+
+    def __init__(self, addr1, addr2, cache):
+        self.addr1 = addr1
+        self.addr2 = addr2
+        self.cache = cache
+
+    def similarity(self, function, mask, view1, view2, swap=False):
+        # function(view1 of the first address, view2 of the second)
+        # for the pairs where mask is set, 0 elsewhere.
+        # swap takes view1 from the second address and view2 from the first
+        first, second = (self.addr2, self.addr1) if swap else (self.addr1, self.addr2)
+        result = np.zeros(len(mask))
+        rows = np.flatnonzero(mask)
+        if len(rows):
+            result[rows] = getattr(self.cache, function)(
+                address_view(first, view1, rows), address_view(second, view2, rows)
+            )
+        return result
+
+
+class EncodedAddresses:
+    """The same comparisons as AddressStrings, for pairs of distinct addresses
+    of an AddressEncoding (see AddressEncoding.address_ids),
+    looked up in its similarity matrices"""
+
+    def __init__(self, encoding, left, right, cache):
+        self.encoding = encoding
+        self.left = left
+        self.right = right
+        self.cache = cache
+        self.addr1 = {c: encoding.strings[c][left] for c in ADDRESS_COLUMNS}
+        self.addr2 = {c: encoding.strings[c][right] for c in ADDRESS_COLUMNS}
+
+    def similarity(self, function, mask, view1, view2, swap=False):
+        first, second = (self.right, self.left) if swap else (self.left, self.right)
+        result = np.zeros(len(mask))
+        rows = np.flatnonzero(mask)
+        if len(rows):
+            result[rows] = self.encoding.similarity(
+                function, view1, view2, first[rows], second[rows], self.cache
+            )
+        return result
+
+
+class AddressEncoding:
+    """Address components dictionary-encoded within each zip code.
+    Candidate pairs always share a zip, and each zip only has a small number
+    of distinct streets, suffixes, unit numbers etc, so for each of the
+    ADDRESS_COMPARISONS a matrix of the similarity between every pair of
+    distinct values is computed once per zip.
+    Comparing a pair of rows is then an integer lookup into that matrix.
+
+    Everything is kept per distinct (zip, address) rather than per row,
+    with address_ids mapping each row of pii_lines to its address,
+    so the views of the addresses take memory in proportion to the number
+    of addresses, not the number of people living at them.
+
+    A matrix is only computed when it takes no more comparisons than there are
+    candidate pairs in the zip (eg. not for whole addresses in a large zip),
+    otherwise those pairs are compared through the SimilarityCache.
+    """
+
+    def __init__(self, pii_lines, candidate_links, debug=False):
+        row_zip_ids, zips = pd.factorize(pii_lines["household_zip"])
+        n_zips = len(zips)
+        pairs_per_zip = np.bincount(row_zip_ids[candidate_links[0]], minlength=n_zips)
+
+        # number the distinct addresses, in zip order so that
+        # the addresses of each zip are a contiguous range
+        address_codes, distinct_addresses = pd.factorize(
+            pii_lines["household_street_address"]
+        )
+        address_keys, first_rows, address_ids = np.unique(
+            row_zip_ids.astype(np.int64) * max(len(distinct_addresses), 1)
+            + address_codes,
+            return_index=True,
+            return_inverse=True,
+        )
+        del row_zip_ids, address_codes
+        self.address_ids = address_ids.astype(np.int32)
+        self.zip_ids = address_keys // max(len(distinct_addresses), 1)
+
+        views = set(ADDRESS_COLUMNS) | {
+            view for _, view1, view2 in ADDRESS_COMPARISONS for view in (view1, view2)
+        }
+        addr = {
+            c: pii_lines[c].iloc[first_rows].to_numpy(dtype=object)
+            for c in ADDRESS_COLUMNS
+        }
+        all_addresses = np.arange(len(address_keys))
+        self.strings = {}
+        self.codes = {}
+        values = {}
+        starts = {}
+        for view in views:
+            strings = address_view(addr, view, all_addresses)
+            self.strings[view] = strings
+            # number the distinct values of the view within each zip
+            value_ids, distinct_values = pd.factorize(strings)
+            zip_values, inverse = np.unique(
+                self.zip_ids * len(distinct_values) + value_ids,
+                return_inverse=True,
+            )
+            zip_starts = np.searchsorted(
+                zip_values // max(len(distinct_values), 1), np.arange(n_zips + 1)
+            )
+            self.codes[view] = (inverse - zip_starts[self.zip_ids]).astype(np.int32)
+            values[view] = np.asarray(distinct_values, dtype=object)[
+                zip_values % max(len(distinct_values), 1)
+            ]
+            starts[view] = zip_starts
+
+        # each comparison's matrices are stored flattened one after another,
+        # with the offset of each zip's matrix, or -1 if it has none
+        self.matrices = {}
+        n_entries = 0
+        for comparison in ADDRESS_COMPARISONS:
+            function, view1, view2 = comparison
+            sizes1 = np.diff(starts[view1])
+            sizes2 = np.diff(starts[view2])
+            entries = sizes1 * sizes2
+            has_matrix = entries <= pairs_per_zip
+            offsets = np.where(
+                has_matrix, np.cumsum(np.where(has_matrix, entries, 0)) - entries, -1
+            )
+            first = []
+            second = []
+            for z in np.flatnonzero(has_matrix):
+                values1 = values[view1][starts[view1][z] : starts[view1][z + 1]]
+                values2 = values[view2][starts[view2][z] : starts[view2][z + 1]]
+                first.append(np.repeat(values1, len(values2)))
+                second.append(np.tile(values2, len(values1)))
+            if first:
+                flat = SIMILARITY_FUNCTIONS[function](
+                    np.concatenate(first), np.concatenate(second)
+                )
+            else:
+                flat = np.zeros(0)
+            self.matrices[comparison] = (flat, offsets, sizes2)
+            n_entries += len(flat)
+
+        if debug:
+            print(
+                f"[{datetime.now()}] Encoded address components of"
+                f" {len(address_keys)} addresses in {n_zips} zips,"
+                f" {n_entries} similarity matrix entries"
+            )
+
+    def similarity(self, function, view1, view2, first, second, cache):
+        # function(view1 of the addresses at first, view2 of those at second),
+        # where each pair of addresses shares a zip
+        flat, offsets, widths = self.matrices[(function, view1, view2)]
+        zip_ids = self.zip_ids[first]
+        pair_offsets = offsets[zip_ids]
+        in_matrix = pair_offsets >= 0
+
+        result = np.empty(len(first))
+        codes1 = self.codes[view1][first[in_matrix]].astype(np.int64)
+        codes2 = self.codes[view2][second[in_matrix]]
+        result[in_matrix] = flat[
+            pair_offsets[in_matrix] + codes1 * widths[zip_ids[in_matrix]] + codes2
+        ]
+        rest = ~in_matrix
+        if rest.any():
+            result[rest] = getattr(cache, function)(
+                self.strings[view1][first[rest]], self.strings[view2][second[rest]]
+            )
+        return result
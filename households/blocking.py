@@ -0,0 +1,271 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from households.telemetry import stage
+
+# upper bound on how many pairs to materialize at once when expanding
+# groups of the same size, to keep temporary index arrays small
+PAIR_BATCH_SIZE = 10_000_000
+# how many of the rows after it each row of a capped group is paired with,
+# when sorted on the block's sort key, see BlockCap
+DEFAULT_BLOCK_WINDOW = 10
+# capped groups listed by name in the --debug report
+REPORT_LARGEST_GROUPS = 20
+
+
+class BlockCap:
+    """A limit on the size of any one group of rows sharing a block key.
+    All pairs within a group grow quadratically, so a group with more than
+    max_size rows (eg. a common family name, or no family name, in a dense zip)
+    is instead sorted on a secondary key, and each row is paired with the
+    next window - 1 rows in that order (a sorted neighbourhood)
+    """
+
+    def __init__(self, max_size, window=DEFAULT_BLOCK_WINDOW):
+        self.max_size = max_size
+        self.window = window
+
+    def oversized(self, sizes):
+        return sizes > self.max_size
+
+    def window_pair_counts(self, sizes):
+        # pairs within a sorted neighbourhood window of each group size
+        sizes = np.asarray(sizes, dtype=np.int64)
+        steps = np.minimum(sizes, self.window) - 1
+        # sum of (size - k) for k in 1..steps
+        return steps * sizes - steps * (steps + 1) // 2
+
+
+def position_dtype(n_rows):
+    # row positions fit in 32 bits for anything but enormous files
+    return np.int32 if n_rows < np.iinfo(np.int32).max else np.int64
+
+
+def block_groups(df, columns):
+    """Group number for every row of df that shares all the given columns,
+    or -1 where any of them is missing (NaN). Columns may be categorical,
+    only the combinations of values that occur are groups"""
+    return df.groupby(columns, sort=False, observed=True).ngroup().to_numpy()
+
+
+def group_pairs(group_ids, positions, dtype=np.int32, batch_size=PAIR_BATCH_SIZE):
+    """All pairs of rows that share a group, as two arrays (left, right)
+    with left < right, ie. the upper triangle of each group.
+    positions must be ascending.
+    At most batch_size pairs are expanded at once.
+    """
+    keep = group_ids >= 0
+    group_ids = group_ids[keep]
+    positions = positions[keep]
+
+    order = np.argsort(group_ids, kind="stable")
+    sorted_groups = group_ids[order]
+    members = positions[order]
+    boundaries = np.flatnonzero(sorted_groups[1:] != sorted_groups[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    sizes = np.diff(np.concatenate((starts, [len(members)])))
+
+    lefts = []
+    rights = []
+    # groups of the same size all have the same upper triangle offsets,
+    # so expand each size class with one broadcast
+    for size in np.unique(sizes[sizes > 1]):
+        size_starts = starts[sizes == size]
+        pairs_per_group = size * (size - 1) // 2
+        if pairs_per_group > batch_size:
+            # too big to broadcast, go one row at a time
+            for start in size_starts:
+                group = members[start : start + size]
+                for i in range(size - 1):
+                    lefts.append(np.full(size - i - 1, group[i], dtype=dtype))
+                    rights.append(group[i + 1 :].astype(dtype))
+            continue
+
+        first, second = np.triu_indices(size, 1)
+        batch = max(batch_size // pairs_per_group, 1)
+        for b in range(0, len(size_starts), batch):
+            batch_starts = size_starts[b : b + batch, None]
+            lefts.append(members[batch_starts + first].ravel().astype(dtype))
+            rights.append(members[batch_starts + second].ravel().astype(dtype))
+
+    if not lefts:
+        return np.zeros(0, dtype=dtype), np.zeros(0, dtype=dtype)
+    return np.concatenate(lefts), np.concatenate(rights)
+
+
+def window_pairs(group_ids, sort_codes, positions, window, dtype=np.int32):
+    """Pairs of rows that share a group and are fewer than window rows apart
+    when the group is sorted on sort_codes (a list of integer arrays,
+    most significant first), as two arrays (left, right) with left < right
+    """
+    keep = group_ids >= 0
+    order = np.lexsort(
+        [codes[keep] for codes in reversed(sort_codes)] + [group_ids[keep]]
+    )
+    sorted_groups = group_ids[keep][order]
+    members = positions[keep][order]
+
+    lefts = []
+    rights = []
+    for step in range(1, window):
+        same_group = sorted_groups[step:] == sorted_groups[:-step]
+        first = members[:-step][same_group]
+        second = members[step:][same_group]
+        lefts.append(np.minimum(first, second).astype(dtype))
+        rights.append(np.maximum(first, second).astype(dtype))
+    if not lefts:
+        return np.zeros(0, dtype=dtype), np.zeros(0, dtype=dtype)
+    return np.concatenate(lefts), np.concatenate(rights)
+
+
+def estimate_pair_count(groups, block_cap=None):
+    """Upper bound on the number of candidate pairs from several blocks,
+    given each block's group numbers (as from block_groups):
+    the pairs within every group, before pairs found by more than one block
+    are deduplicated"""
+    total = 0
+    for group_ids in groups:
+        sizes = np.bincount(group_ids[group_ids >= 0]).astype(np.int64)
+        pairs = sizes * (sizes - 1) // 2
+        if block_cap is not None:
+            oversized = block_cap.oversized(sizes)
+            pairs[oversized] = block_cap.window_pair_counts(sizes[oversized])
+        total += int(pairs.sum())
+    return total
+
+
+def dedupe_pairs(lefts, rights, n_rows, dtype=np.int32):
+    """Union of several (left, right) pair arrays without duplicates,
+    sorted by left then right"""
+    codes = np.unique(
+        np.concatenate(
+            [
+                left.astype(np.int64) * n_rows + right
+                for left, right in zip(lefts, rights)
+            ]
+        )
+    )
+    return (codes // n_rows).astype(dtype), (codes % n_rows).astype(dtype)
+
+
+def block_candidate_pairs(
+    df,
+    blocks,
+    n_rows,
+    debug=False,
+    batch_size=PAIR_BATCH_SIZE,
+    groups=None,
+    block_cap=None,
+    sort_keys=None,
+    telemetry=None,
+):
+    """Candidate pairs of df rows that agree on every column of
+    at least one of the blocks (each a list of column names).
+    This is the same set of pairs as recordlinkage's Index.block,
+    filtered to left < right, but built by grouping rows on each block key
+    and emitting the pairs within each group directly.
+    Pairs are row positions, ie. values of df.index.
+    groups are the block_groups of each block, if they've already been found.
+    With a block_cap, groups over its size are paired by sorted neighbourhood
+    on the block's sort_keys (a list of column names per block) instead.
+    With a Telemetry, each block is recorded as a stage.
+    """
+    dtype = position_dtype(n_rows)
+    positions = df.index.to_numpy()
+    if groups is None:
+        groups = [block_groups(df, columns) for columns in blocks]
+    lefts = []
+    rights = []
+    if sort_keys is None:
+        sort_keys = [None] * len(blocks)
+    for columns, group_ids, sort_key in zip(blocks, groups, sort_keys):
+        with stage(telemetry, "blocking_pass", block=columns, rows=len(df)) as metrics:
+            sizes = np.bincount(group_ids[group_ids >= 0])
+            if block_cap is not None and block_cap.oversized(sizes).any():
+                left, right = capped_block_pairs(
+                    df,
+                    columns,
+                    group_ids,
+                    sizes,
+                    sort_key,
+                    block_cap,
+                    dtype,
+                    batch_size,
+                    debug,
+                )
+            else:
+                left, right = group_pairs(group_ids, positions, dtype, batch_size)
+            metrics["pairs"] = len(left)
+        if debug:
+            print(f"[{datetime.now()}]  Blocking on {columns}: {len(left)} pairs")
+        lefts.append(left)
+        rights.append(right)
+
+    if len(lefts) == 1:
+        return lefts[0], rights[0]
+    return dedupe_pairs(lefts, rights, n_rows, dtype)
+
+
+def capped_block_pairs(
+    df,
+    columns,
+    group_ids,
+    sizes,
+    sort_key,
+    block_cap,
+    dtype=np.int32,
+    batch_size=PAIR_BATCH_SIZE,
+    debug=False,
+):
+    # the pairs of one block, where its groups over block_cap's size are
+    # paired by sorted neighbourhood on sort_key rather than all against all
+    positions = df.index.to_numpy()
+    capped = block_cap.oversized(sizes)
+    in_capped = (group_ids >= 0) & capped[np.maximum(group_ids, 0)]
+    left, right = group_pairs(
+        np.where(in_capped, -1, group_ids), positions, dtype, batch_size
+    )
+    sort_codes = [pd.factorize(df[column], sort=True)[0] for column in sort_key]
+    capped_left, capped_right = window_pairs(
+        np.where(in_capped, group_ids, -1),
+        sort_codes,
+        positions,
+        block_cap.window,
+        dtype,
+    )
+    report_capped_groups(df, columns, group_ids, sizes, sort_key, block_cap, debug)
+    return np.concatenate((left, capped_left)), np.concatenate((right, capped_right))
+
+
+def report_capped_groups(
+    df, columns, group_ids, sizes, sort_key, block_cap, debug=False
+):
+    # which groups of a block were capped, and how many pairs that avoided.
+    # the block key values are PII, so groups are only listed with --debug
+    capped_groups = np.flatnonzero(block_cap.oversized(sizes))
+    full_pairs = sizes[capped_groups].astype(np.int64)
+    full_pairs = full_pairs * (full_pairs - 1) // 2
+    windowed_pairs = block_cap.window_pair_counts(sizes[capped_groups])
+    print(
+        f"Capped {len(capped_groups)} groups of {columns} over"
+        f" {block_cap.max_size} rows ({int(sizes[capped_groups].sum())} rows),"
+        f" pairing them by sorted neighbourhood on {sort_key}:"
+        f" {int(windowed_pairs.sum())} pairs instead of {int(full_pairs.sum())}"
+    )
+    if debug:
+        # the first row of each group has its block key values
+        first_rows = np.full(len(sizes), -1, dtype=np.int64)
+        rows = np.flatnonzero(group_ids >= 0)
+        first_rows[group_ids[rows[::-1]]] = rows[::-1]
+        largest = capped_groups[np.argsort(-sizes[capped_groups], kind="stable")]
+        for group in largest[:REPORT_LARGEST_GROUPS]:
+            key = df[columns].iloc[first_rows[group]].tolist()
+            avoided = sizes[group] * (sizes[group] - 1) // 2 - int(
+                block_cap.window_pair_counts(sizes[group])
+            )
+            print(
+                f"[{datetime.now()}]   {key}: {sizes[group]} rows,"
+                f" {avoided} pairs avoided"
+            )
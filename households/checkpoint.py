@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from households.address_encoding import PARSED_COLUMNS
+from households.pairs_file import PAIRS_SUFFIX, read_pairs_file, write_pairs_file
+
+# a checkpoint directory holds
+#   checkpoint.json           what the run was started from, and every stage done
+#   addresses.csv             the parsed address of every PII row
+#   candidates.pairs          the candidate pairs
+#   matches-START.pairs       the matching pairs among candidates [START, stop)
+# each file is only listed in checkpoint.json once it has been written in full
+CHECKPOINT_FILE = "checkpoint.json"
+ADDRESSES_FILE = "addresses.csv"
+CANDIDATES_FILE = f"candidates{PAIRS_SUFFIX}"
+MATCHES_PREFIX = "matches-"
+
+
+class Checkpoint:
+    """The completed stages of household inference for one PII file,
+    saved as they finish so that a run that's stopped part way
+    (eg. out of memory, or the VM was preempted) can be resumed:
+    the parsed addresses, the candidate pairs, and the matching pairs
+    of each batch of candidates compared.
+    Everything is keyed on a hash of the PII file and the settings that change
+    the matches, so a checkpoint is never resumed for different inputs.
+    Unless resuming, any earlier checkpoint in checkpoint_dir is discarded.
+    """
+
+    def __init__(
+        self,
+        checkpoint_dir,
+        pii_sha256,
+        pii_timestamp,
+        n_rows,
+        settings,
+        resume=False,
+        debug=False,
+    ):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.pii_timestamp = pii_timestamp
+        self.n_rows = n_rows
+        self.debug = debug
+        key = {"pii_sha256": pii_sha256, "pii_rows": n_rows, **settings}
+        self.key = hashlib.sha256(
+            json.dumps(key, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+        saved = self.read() if resume else None
+        if saved is not None and saved["key"] != self.key:
+            print(
+                f"Checkpoint in {self.checkpoint_dir} was made from a different"
+                " PII file or settings, starting over"
+            )
+            saved = None
+        elif resume and saved is None:
+            print(f"No checkpoint in {self.checkpoint_dir}, starting over")
+
+        if saved is None:
+            self.remove()
+            self.stages = {"addresses": None, "candidates": None, "matches": []}
+            self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+            self.write()
+        else:
+            self.stages = saved["stages"]
+            print(f"Resuming from the checkpoint in {self.checkpoint_dir}")
+
+    def read(self):
+        path = self.checkpoint_dir / CHECKPOINT_FILE
+        if not path.exists():
+            return None
+        with open(path) as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def write(self):
+        # replaced in one step, so it always lists only complete files
+        path = self.checkpoint_dir / CHECKPOINT_FILE
+        temp_path = path.with_suffix(".tmp")
+        checkpoint = {
+            "key": self.key,
+            "pii_timestamp": self.pii_timestamp,
+            "updated": datetime.now().isoformat(),
+            "stages": self.stages,
+        }
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file, indent=2)
+        os.replace(temp_path, path)
+
+    def remove(self):
+        # only the files a checkpoint writes, in case checkpoint_dir holds others
+        if not self.checkpoint_dir.exists():
+            return
+        paths = [
+            self.checkpoint_dir / ADDRESSES_FILE,
+            self.checkpoint_dir / CANDIDATES_FILE,
+            *self.checkpoint_dir.glob(f"{MATCHES_PREFIX}*{PAIRS_SUFFIX}"),
+            self.checkpoint_dir / CHECKPOINT_FILE,
+            (self.checkpoint_dir / CHECKPOINT_FILE).with_suffix(".tmp"),
+        ]
+        for path in paths:
+            path.unlink(missing_ok=True)
+        if not any(self.checkpoint_dir.iterdir()):
+            self.checkpoint_dir.rmdir()
+
+    def log(self, message):
+        if self.debug:
+            print(f"[{datetime.now()}] {message}")
+
+    def load_addresses(self):
+        # the parsed address columns of every row, or None if not saved yet
+        if self.stages["addresses"] is None:
+            return None
+        self.log("Loading parsed addresses from the checkpoint")
+        return pd.read_csv(
+            self.checkpoint_dir / self.stages["addresses"],
+            dtype="category",
+            keep_default_na=False,
+        )
+
+    def save_addresses(self, pii_lines_exploded):
+        pii_lines_exploded[PARSED_COLUMNS].to_csv(
+            self.checkpoint_dir / ADDRESSES_FILE, index=False
+        )
+        self.stages["addresses"] = ADDRESSES_FILE
+        self.write()
+        self.log("Checkpointed parsed addresses")
+
+    def load_candidates(self):
+        if self.stages["candidates"] is None:
+            return None
+        self.log("Loading candidate pairs from the checkpoint")
+        return self._read_pairs(self.stages["candidates"])
+
+    def save_candidates(self, candidate_links):
+        write_pairs_file(
+            self.checkpoint_dir / CANDIDATES_FILE,
+            candidate_links,
+            self.pii_timestamp,
+            self.n_rows,
+        )
+        self.stages["candidates"] = CANDIDATES_FILE
+        self.write()
+        self.log(f"Checkpointed {len(candidate_links[0])} candidate pairs")
+
+    def load_matches(self):
+        """The matching pairs found so far, as lists of (left, right) arrays
+        for each batch, and the number of candidate pairs they came from.
+        Batches are saved in order, so comparing resumes from there
+        """
+        lefts = []
+        rights = []
+        compared = 0
+        for start, stop, name in self.stages["matches"]:
+            if start != compared:
+                break
+            left, right = self._read_pairs(name)
+            lefts.append(left)
+            rights.append(right)
+            compared = stop
+        # the batches after this are compared again
+        self.stages["matches"] = self.stages["matches"][: len(lefts)]
+        if compared:
+            self.log(f"Loaded the matches of {compared} candidate pairs")
+        return lefts, rights, compared
+
+    def save_matches(self, start, stop, matching_pairs):
+        name = f"{MATCHES_PREFIX}{start}{PAIRS_SUFFIX}"
+        write_pairs_file(
+            self.checkpoint_dir / name, matching_pairs, self.pii_timestamp, self.n_rows
+        )
+        self.stages["matches"].append([start, stop, name])
+        self.write()
+
+    def _read_pairs(self, name):
+        left, right = read_pairs_file(
+            self.checkpoint_dir / name, self.pii_timestamp, self.n_rows
+        )
+        return np.asarray(left), np.asarray(right)
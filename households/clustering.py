@@ -0,0 +1,64 @@
+import numpy as np
+
+
+def connected_components(n_rows, left, right):
+    """Label every row with the component it belongs to in the graph of
+    matching pairs, where left[i] and right[i] are the row positions of pair i.
+    The label of a component is the smallest row position in it,
+    so rows with no matches are labelled with their own position.
+
+    This is an array-backed union-find: each pass hooks the root of every
+    pair's endpoints onto the smaller of the two roots, then compresses
+    paths by pointer jumping until every row points directly at its root.
+    Both steps are whole-array numpy operations, and the number of passes
+    grows roughly with the log of the component diameter.
+    """
+    dtype = np.int32 if n_rows < np.iinfo(np.int32).max else np.int64
+    labels = np.arange(n_rows, dtype=dtype)
+    left = np.asarray(left, dtype=dtype)
+    right = np.asarray(right, dtype=dtype)
+    if len(left) == 0:
+        return labels
+
+    while True:
+        left_roots = labels[left]
+        right_roots = labels[right]
+        differ = left_roots != right_roots
+        if not differ.any():
+            return labels
+        # only pairs that are not yet in the same component need hooking
+        left_roots = left_roots[differ]
+        right_roots = right_roots[differ]
+        smaller = np.minimum(left_roots, right_roots)
+        np.minimum.at(labels, left_roots, smaller)
+        np.minimum.at(labels, right_roots, smaller)
+
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+
+def group_components(labels):
+    """Group row positions by component label.
+    Returns (order, starts): order is the row positions sorted by label
+    (ascending position within each component), and component i is
+    order[starts[i]:starts[i + 1]].
+    """
+    order = np.argsort(labels, kind="stable")
+    if len(labels) == 0:
+        return order, np.zeros(1, dtype=np.int64)
+    sorted_labels = labels[order]
+    boundaries = np.flatnonzero(sorted_labels[1:] != sorted_labels[:-1]) + 1
+    starts = np.concatenate(([0], boundaries, [len(labels)]))
+    return order, starts
+
+
+def component_pairs(labels):
+    """Pairs that connect every row to its component's label, as two arrays
+    (left, right) with left < right. connected_components of these pairs
+    gives back labels, with one pair per row rather than every matching pair.
+    """
+    rows = np.flatnonzero(labels != np.arange(len(labels))).astype(labels.dtype)
+    return labels[rows], rows
@@ -0,0 +1,280 @@
+import hashlib
+import json
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from households.address_encoding import PARSED_COLUMNS
+from households.blocking import position_dtype
+from households.clustering import connected_components
+from households.matching import (
+    explode_addresses,
+    get_candidate_links,
+    get_matching_pairs,
+)
+from households.memory import MemoryBudget
+from households.pairs_file import read_pairs_file, write_pairs_file
+from households.partitioning import INFERENCE_COLUMNS
+from households.shards import file_sha256
+
+# an incremental state directory holds
+#   state.json      the run that wrote it, and checksums of the other files
+#   records.csv     the fingerprint and parsed address of every distinct record
+#   matches.pairs   the matching pairs of records, as positions in records.csv
+# where a record is the fields household inference reads (INFERENCE_COLUMNS),
+# so rows with the same record always match the same other rows.
+# the parsed addresses are PII, so a state directory has to be protected
+# the same way as temp-data/
+STATE_FILE = "state.json"
+RECORDS_FILE = "records.csv"
+MATCHES_FILE = "matches.pairs"
+# bump when a change to matching means earlier matches can't be reused
+STATE_VERSION = 2
+FINGERPRINT_COLUMN = "fingerprint"
+
+
+def record_fingerprints(pii_lines, secret):
+    # a digest of each row's record, to recognise unchanged records
+    # in a later submission. names and phone numbers have few enough values
+    # to be guessed from an unkeyed digest, so it is keyed with the
+    # households secret (derive_subkey(secret, "households"))
+    key = bytes.fromhex(secret)[: hashlib.blake2b.MAX_KEY_SIZE]
+    columns = [pii_lines[c].to_numpy(dtype=object) for c in INFERENCE_COLUMNS]
+    return np.array(
+        [
+            hashlib.blake2b(
+                "\0".join(values).encode("utf-8"), digest_size=16, key=key
+            ).digest()
+            for values in zip(*columns)
+        ],
+        dtype=object,
+    )
+
+
+def read_state(state_dir, address_lsh):
+    """The records and matches saved by the last incremental run,
+    as (fingerprints, parsed addresses, (left, right)), or None to compare
+    every record, eg. on the first run or if the settings have changed
+    """
+    state_dir = Path(state_dir)
+    state_path = state_dir / STATE_FILE
+    if not state_path.exists():
+        print(f"No incremental state in {state_dir}, comparing every record")
+        return None
+    with open(state_path) as state_file:
+        state = json.load(state_file)
+    if state["version"] != STATE_VERSION or state["address_lsh"] != address_lsh:
+        print(
+            f"Incremental state in {state_dir} was saved by a different version"
+            " or with different settings, comparing every record"
+        )
+        return None
+
+    records_path = state_dir / RECORDS_FILE
+    matches_path = state_dir / MATCHES_FILE
+    for path in (records_path, matches_path):
+        if not path.exists() or file_sha256(path) != state[path.name]:
+            print(
+                f"WARNING: {path} has changed since the incremental state was"
+                " saved, comparing every record"
+            )
+            return None
+
+    records = pd.read_csv(records_path, dtype=str, keep_default_na=False)
+    fingerprints = np.array(
+        [bytes.fromhex(value) for value in records.pop(FINGERPRINT_COLUMN)],
+        dtype=object,
+    )
+    left, right = read_pairs_file(matches_path, state["pii_timestamp"], len(records))
+    return fingerprints, records, (np.asarray(left), np.asarray(right))
+
+
+def write_state(state_dir, pii_timestamp, fingerprints, parsed, matches, address_lsh):
+    state_dir = Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    records_path = state_dir / RECORDS_FILE
+    matches_path = state_dir / MATCHES_FILE
+
+    records = parsed[PARSED_COLUMNS].copy()
+    records.insert(0, FINGERPRINT_COLUMN, [value.hex() for value in fingerprints])
+    records.to_csv(records_path, index=False)
+    write_pairs_file(matches_path, matches, pii_timestamp, len(records))
+
+    # written last, so a run that stops part way leaves checksums that don't match
+    state = {
+        "version": STATE_VERSION,
+        "pii_timestamp": pii_timestamp,
+        "created": datetime.now().isoformat(),
+        "address_lsh": address_lsh,
+        "records": len(records),
+        "matches": len(matches[0]),
+        RECORDS_FILE: file_sha256(records_path),
+        MATCHES_FILE: file_sha256(matches_path),
+    }
+    with open(state_dir / STATE_FILE, "w") as state_file:
+        json.dump(state, state_file, indent=2)
+
+
+def match_new_records(records, is_new, split_factor, debug, memory_budget, address_lsh):
+    """Matching pairs of records that involve at least one new record,
+    as (left, right) positions in records. A pair (i, i) means two rows
+    with record i match each other.
+    Every candidate pair shares a zip, so only the zips with a new record
+    are blocked, and of those pairs only ones with a new record are compared
+    """
+    local = np.flatnonzero(
+        records["household_zip"].isin(records["household_zip"][is_new]).to_numpy()
+    )
+    local_records = records.iloc[local].reset_index(drop=True)
+    local_new = is_new[local]
+
+    left, right = get_candidate_links(
+        local_records, debug, memory_budget, None, address_lsh
+    )
+    keep = local_new[left] | local_new[right]
+    # any two rows with the same record are a candidate pair if it has an address
+    same = np.flatnonzero(
+        local_new & (local_records["household_street_address"] != "").to_numpy()
+    ).astype(left.dtype)
+    candidate_links = (
+        np.concatenate((left[keep], same)),
+        np.concatenate((right[keep], same)),
+    )
+    if debug:
+        print(
+            f"[{datetime.now()}] Comparing {len(candidate_links[0])} candidate pairs"
+            f" of {len(local_records)} records in zips with a new record"
+        )
+    if len(candidate_links[0]) == 0:
+        return local[:0], local[:0]
+
+    matches = get_matching_pairs(
+        local_records,
+        candidate_links,
+        split_factor,
+        debug,
+        memory_budget=memory_budget,
+    )
+    return local[matches[0]], local[matches[1]]
+
+
+def household_pairs(record_ids, first_rows, matches, dtype):
+    """Pairs of rows whose connected components are the households, given
+    the matching pairs of records. Every row of a record that matches
+    anything (itself included) is in the household of that record's
+    first row, and each match between two records links their first rows
+    """
+    left, right = matches
+    n_rows = len(record_ids)
+    matched = np.zeros(len(first_rows), dtype=bool)
+    matched[left] = True
+    matched[right] = True
+    rows = np.flatnonzero(
+        matched[record_ids] & (first_rows[record_ids] != np.arange(n_rows))
+    )
+    between = left != right
+    pair_left = np.concatenate(
+        (first_rows[left[between]], first_rows[record_ids[rows]])
+    )
+    pair_right = np.concatenate((first_rows[right[between]], rows))
+    return (
+        np.minimum(pair_left, pair_right).astype(dtype),
+        np.maximum(pair_left, pair_right).astype(dtype),
+    )
+
+
+def get_incremental_household_matches(
+    pii_lines,
+    state_dir,
+    pii_timestamp,
+    secret,
+    split_factor=None,
+    debug=False,
+    workers=None,
+    memory_budget=None,
+    address_lsh=False,
+):
+    """The same households as get_household_matches, only comparing the
+    records that are new since the last run that saved its state to state_dir.
+    Matches between records that are still present are reused, and those of
+    records that are gone (eg. a member's old address) are dropped,
+    so households split as well as merge. The state is then updated.
+    Records are recognised by their fingerprint keyed with secret,
+    so changing the secret compares every record again.
+    Returns (labels, matching_pairs), where matching_pairs are just enough
+    pairs of pii_lines positions to rebuild the households.
+    """
+    if split_factor is None:
+        memory_budget = memory_budget or MemoryBudget()
+    else:
+        memory_budget = None
+    n_rows = len(pii_lines)
+    dtype = position_dtype(n_rows)
+
+    if debug:
+        print(f"[{datetime.now()}] Fingerprinting records")
+    fingerprints = record_fingerprints(pii_lines, secret)
+    record_ids, distinct = pd.factorize(fingerprints)
+    n_records = len(distinct)
+    # each record is compared as its first row
+    first_rows = np.empty(n_records, dtype=dtype)
+    first_rows[record_ids[::-1]] = np.arange(n_rows - 1, -1, -1)
+    records = pii_lines.iloc[first_rows][INFERENCE_COLUMNS].reset_index(drop=True)
+
+    state = read_state(state_dir, address_lsh)
+    if state is None:
+        previous_fingerprints = np.zeros(0, dtype=object)
+        previous_records = pd.DataFrame(columns=PARSED_COLUMNS, dtype=object)
+        previous_matches = (np.zeros(0, dtype=dtype), np.zeros(0, dtype=dtype))
+    else:
+        previous_fingerprints, previous_records, previous_matches = state
+    previous_ids = pd.Index(previous_fingerprints).get_indexer(distinct)
+    is_new = previous_ids < 0
+    known = np.flatnonzero(~is_new)
+
+    # addresses of known records were parsed when they were new
+    parsed = records[is_new]
+    if len(parsed):
+        parsed = explode_addresses(parsed, workers, debug)
+    for column in PARSED_COLUMNS:
+        values = np.empty(n_records, dtype=object)
+        values[known] = previous_records[column].to_numpy(dtype=object)[
+            previous_ids[known]
+        ]
+        if len(parsed):
+            values[is_new] = parsed[column].to_numpy(dtype=object)
+        records[column] = values
+
+    # matches between records that are still present stand
+    current_ids = np.full(len(previous_fingerprints), -1, dtype=np.int64)
+    current_ids[previous_ids[known]] = known
+    kept_left = current_ids[previous_matches[0]]
+    kept_right = current_ids[previous_matches[1]]
+    kept = (kept_left >= 0) & (kept_right >= 0)
+    new_left, new_right = match_new_records(
+        records, is_new, split_factor, debug, memory_budget, address_lsh
+    )
+    left = np.concatenate((kept_left[kept], new_left))
+    right = np.concatenate((kept_right[kept], new_right))
+    record_dtype = position_dtype(n_records)
+    matches = (
+        np.minimum(left, right).astype(record_dtype),
+        np.maximum(left, right).astype(record_dtype),
+    )
+
+    if debug:
+        print(
+            f"[{datetime.now()}] {n_records} distinct records, {int(is_new.sum())}"
+            f" new, {len(previous_fingerprints) - len(known)} no longer present."
+            f" Kept {int(kept.sum())} matches, found {len(new_left)} new ones"
+        )
+
+    matching_pairs = household_pairs(record_ids, first_rows, matches, dtype)
+    labels = connected_components(n_rows, *matching_pairs)
+
+    write_state(state_dir, pii_timestamp, distinct, records, matches, address_lsh)
+    if debug:
+        print(f"[{datetime.now()}] Saved incremental state to {state_dir}")
+    return labels, matching_pairs
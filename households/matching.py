@@ -1,16 +1,47 @@
-import csv
 import gc
+import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import recordlinkage
-import textdistance
 import usaddress
-from recordlinkage.base import BaseCompareFeature
 
 from definitions import TIMESTAMP_FMT
+from households.address_encoding import (
+    ADDRESS_COLUMNS,
+    PARSED_COLUMNS,
+    AddressEncoding,
+    AddressStrings,
+    EncodedAddresses,
+)
+from households.blocking import (
+    PAIR_BATCH_SIZE,
+    block_candidate_pairs,
+    block_groups,
+    dedupe_pairs,
+    estimate_pair_count,
+    position_dtype,
+)
+from households.clustering import component_pairs, connected_components
+from households.lsh import lsh_candidate_pairs
+from households.memory import (
+    COMPARE_BYTES_PER_PAIR,
+    INDEX_BYTES_PER_PAIR,
+    MAX_COMPARE_BATCH,
+    MIN_COMPARE_BATCH,
+    MIN_INDEX_BATCH,
+    MemoryBudget,
+)
+from households.pairs_file import PAIRS_SUFFIX, read_pairs_file, write_pairs_file
+from households.similarity import (
+    SimilarityCache,
+    jaro_winkler,
+    jaro_winkler_upper_bound,
+)
+from households.telemetry import stage
 
 MATCH_THRESHOLD = 0.85
 FN_WEIGHT = 0.25
@@ -30,6 +61,17 @@ ADDR_THRESHOLD = 0.95
 # so 0.95 should give us a good balance of not linking all apartments together
 # while still allowing some room for typos and variation
 
+# with --exact_addresses, a household is every row with the same zip and address
+EXACT_ADDRESS_KEY = ["household_zip", "household_street_address"]
+
+# match_pairs only drops a pair once an upper bound on its score is this far
+# below MATCH_THRESHOLD, so rounding in the bound can never drop a real match
+BOUND_MARGIN = 1e-9
+
+# below this many distinct addresses it's faster to parse them
+# in this process than to start up a process pool
+MIN_ADDRESSES_FOR_POOL = 10000
+
 
 def addr_parse(addr):
     address_dict = {
@@ -59,506 +101,697 @@ def addr_parse(addr):
     return address_dict
 
 
-# Python version of FRIL matchStreetName functionality
-# addr1 and addr2 are dicts that were returned from addr_parse
-def address_distance(addr1, addr2):
-    score = 0
-    secondary_score = 0
+# Python version of FRIL matchStreetName functionality, over a batch of pairs.
+# addr1 and addr2 hold the ADDRESS_COLUMNS of the two sides of each pair,
+# one row per pair (eg. DataFrames, or dicts of arrays),
+# and the result is the score of each pair.
+# every comparison runs as one batch call over the pairs it applies to,
+# and goes through a SimilarityCache, so each distinct pair of strings is only
+# compared once per batch, or once overall if a cache is shared between batches.
+def address_distance(addr1, addr2, cache=None):
+    if cache is None:
+        cache = SimilarityCache()
+    addr1 = {c: np.asarray(addr1[c], dtype=object) for c in ADDRESS_COLUMNS}
+    addr2 = {c: np.asarray(addr2[c], dtype=object) for c in ADDRESS_COLUMNS}
+    return _address_distance(
+        addr1["household_street_address"],
+        addr2["household_street_address"],
+        cache,
+        lambda rows: AddressStrings(
+            {c: addr1[c][rows] for c in ADDRESS_COLUMNS},
+            {c: addr2[c][rows] for c in ADDRESS_COLUMNS},
+            cache,
+        ),
+    )
 
-    a1 = addr1["household_street_address"]
-    a2 = addr2["household_street_address"]
 
-    if not a1 or not a2:
-        # if either is blank they get a score of 0
-        # this matches textdistance.jaro_winkler("", x)
-        # but textdistance.jaro_winkler("", "") is normally 1
-        # without this, 2 missing addresses could be a "perfect match"
-        # which is not what we want
-        return 0
+def encoded_address_distance(encoding, left, right, cache):
+    # address_distance for the pairs of pii_lines positions (left[i], right[i]),
+    # using the similarity matrices of an AddressEncoding
+    left = encoding.address_ids[left]
+    right = encoding.address_ids[right]
+    addresses = encoding.strings["household_street_address"]
+    return _address_distance(
+        addresses[left],
+        addresses[right],
+        cache,
+        lambda rows: EncodedAddresses(encoding, left[rows], right[rows], cache),
+    )
 
-    if a1 == a2:
-        # if the strings are exactly identical,
-        #  don't waste time with detailed comparisons
-        #  this matches textdistance.jaro_winkler(x, x)
-        return 1
+
+def _address_distance(a1, a2, cache, addresses_at):
+    # addresses_at(rows) gives the AddressStrings or EncodedAddresses
+    # to compare the pairs at rows in detail
+    scores = np.zeros(len(a1))
+
+    # if either is blank they get a score of 0
+    # this matches textdistance.jaro_winkler("", x)
+    # but textdistance.jaro_winkler("", "") is normally 1
+    # without this, 2 missing addresses could be a "perfect match"
+    # which is not what we want
+
+    # if the strings are exactly identical,
+    #  don't waste time with detailed comparisons
+    #  this matches textdistance.jaro_winkler(x, x)
+    scores[(a1 == a2) & (a1 != "")] = 1
+
+    # the components are parsed from the address, and the score is symmetric,
+    # so pairs of addresses that have been scored before can be looked up
+    rows = np.flatnonzero((a1 != "") & (a2 != "") & (a1 != a2))
+    scores[rows] = cache.lookup(
+        "address_distance",
+        a1[rows],
+        a2[rows],
+        lambda distinct: _detailed_address_distance(addresses_at(rows[distinct])),
+    )
+    return scores
+
+
+def _detailed_address_distance(addresses):
+    # address_distance for pairs of distinct, non-blank addresses.
+    # jaro_winkler(mask, view1, view2) compares view1 of the first address
+    # with view2 of the second for the pairs where mask is set, and is 0 elsewhere
+    # (with swap=True, view1 of the second address with view2 of the first).
+    # all scores are >= 0, so taking the max against 0 for pairs
+    # a comparison doesn't apply to leaves their score unchanged
+    addr1, addr2 = addresses.addr1, addresses.addr2
+    jaro_winkler = partial(addresses.similarity, "jaro_winkler")
+    has_number1, has_number2 = addr1["number"] != "", addr2["number"] != ""
+    has_street1, has_street2 = addr1["street"] != "", addr2["street"] != ""
+    has_suffix1, has_suffix2 = addr1["suffix"] != "", addr2["suffix"] != ""
+    has_prefix1, has_prefix2 = addr1["prefix"] != "", addr2["prefix"] != ""
+    has_value1, has_value2 = addr1["value"] != "", addr2["value"] != ""
 
     # Change weights based on existence of second level address
-    if (
-        not addr1["prefix"]
-        and not addr2["prefix"]
-        and not addr1["value"]
-        and not addr2["value"]
-    ):
-        weight_number = 0.5
-        weight_street_name = 0.5
-        weight_secondary = 0
-    else:
-        weight_number = 0.3
-        weight_street_name = 0.5
-        weight_secondary = 0.2
+    no_secondary = ~has_prefix1 & ~has_prefix2 & ~has_value1 & ~has_value2
+    weight_number = np.where(no_secondary, 0.5, 0.3)
+    weight_street_name = 0.5
+    weight_secondary = np.where(no_secondary, 0, 0.2)
 
-    if addr1["number"] and addr2["number"]:
-        score += weight_number * textdistance.hamming.normalized_similarity(
-            addr1["number"], addr2["number"]
-        )
+    score = weight_number * addresses.similarity(
+        "hamming_similarity", has_number1 & has_number2, "number", "number"
+    )
 
-    max_score_str = 0
-    if addr1["street"] and addr2["street"]:
-        # Try perfect match
-        if addr1["suffix"] and addr2["suffix"]:
-            max_score_str = (
-                textdistance.jaro_winkler(addr1["street"], addr2["street"]) * 0.8
-            )
-            if max_score_str:
-                max_score_str += (
-                    textdistance.jaro_winkler(addr1["suffix"], addr2["suffix"]) * 0.2
-                )
-        # Try removing either suffix
-        if addr1["suffix"]:
-            max_score_str = max(
-                max_score_str,
-                textdistance.jaro_winkler(
-                    addr1["street"] + " " + addr1["suffix"], addr2["street"]
-                ),
-            )
-        if addr2["suffix"]:
-            max_score_str = max(
-                max_score_str,
-                textdistance.jaro_winkler(
-                    addr2["street"] + " " + addr2["suffix"], addr1["street"]
-                ),
-            )
-        # Try ignoring suffixes but adjust value by 0.7
-        adjustment = 1.0 if not addr1["suffix"] and not addr2["suffix"] else 0.7
-        max_score_str = max(
+    both_streets = has_street1 & has_street2
+    street_score = jaro_winkler(both_streets, "street", "street")
+    # Try perfect match
+    both_suffixes = both_streets & has_suffix1 & has_suffix2
+    max_score_str = np.where(both_suffixes, street_score * 0.8, 0)
+    add_suffix = both_suffixes & (max_score_str != 0)
+    max_score_str += jaro_winkler(add_suffix, "suffix", "suffix") * 0.2
+    # Try removing either suffix
+    max_score_str = np.maximum(
+        max_score_str,
+        jaro_winkler(both_streets & has_suffix1, "street_suffix", "street"),
+    )
+    max_score_str = np.maximum(
+        max_score_str,
+        jaro_winkler(both_streets & has_suffix2, "street_suffix", "street", swap=True),
+    )
+    # Try ignoring suffixes but adjust value by 0.7
+    adjustment = np.where(~has_suffix1 & ~has_suffix2, 1.0, 0.7)
+    max_score_str = np.where(
+        both_streets,
+        np.maximum(max_score_str, street_score * adjustment),
+        max_score_str,
+    )
+
+    # No street name in one address or both, test each with prefix of other
+    street1_suffix2 = ~both_streets & has_street1 & has_suffix2
+    street2_suffix1 = ~both_streets & has_street2 & has_suffix1
+    for mask, swap in ((street1_suffix2, False), (street2_suffix1, True)):
+        max_score_str = np.maximum(
             max_score_str,
-            textdistance.jaro_winkler(addr1["street"], addr2["street"]) * adjustment,
+            jaro_winkler(mask, "street_suffix", "suffix", swap=swap) * 0.7,
         )
-    else:
-        # No street name in one address or both, test each with prefix of other
-        if addr1["street"] and addr2["suffix"]:
-            max_score_str = max(
-                max_score_str,
-                textdistance.jaro_winkler(
-                    addr1["street"] + " " + addr1["suffix"], addr2["suffix"]
-                )
-                * 0.7,
-            )
-            max_score_str = max(
-                max_score_str,
-                textdistance.jaro_winkler(addr1["street"], addr2["suffix"]) * 0.7,
-            )
-        if addr2["street"] and addr1["suffix"]:
-            max_score_str = max(
-                max_score_str,
-                textdistance.jaro_winkler(
-                    addr2["street"] + " " + addr2["suffix"], addr1["suffix"]
-                )
-                * 0.7,
-            )
-            max_score_str = max(
-                max_score_str,
-                textdistance.jaro_winkler(addr2["street"], addr1["suffix"]) * 0.7,
-            )
-        if (
-            not addr1["street"]
-            and not addr2["street"]
-            and addr1["suffix"]
-            and addr1["street"]
-        ):
-            max_score_str = max(
-                max_score_str,
-                textdistance.jaro_winkler(addr1["suffix"], addr2["suffix"]) * 0.1,
-            )
+        max_score_str = np.maximum(
+            max_score_str, jaro_winkler(mask, "street", "suffix", swap=swap) * 0.7
+        )
+    # the original also compares suffixes * 0.1 when neither address has a street,
+    # but only under a condition that can never be met
+    # (no street in addr1 and a street in addr1), so that is left out here
 
-    if max_score_str:
-        score += max_score_str * weight_street_name
+    score += max_score_str * weight_street_name
 
     # Second level score if something to compare, else leave secondary_score = 0
-    if (addr1["prefix"] and addr2["prefix"]) or (addr1["value"] and addr2["value"]):
-        max_score_sec = 0
-        if addr1["value"] and addr2["value"]:
-            if addr1["prefix"] and addr2["prefix"]:
-                max_score_sec = (
-                    textdistance.jaro_winkler(addr1["value"], addr2["value"]) * 0.8
-                )
-                max_score_sec += (
-                    textdistance.jaro_winkler(addr1["prefix"], addr2["prefix"]) * 0.2
-                )
-            if addr1["prefix"]:
-                max_score_sec = max(
-                    max_score_sec,
-                    textdistance.jaro_winkler(
-                        addr1["prefix"] + " " + addr1["value"], addr2["value"]
-                    ),
-                )
-            if addr2["prefix"]:
-                max_score_sec = max(
-                    max_score_sec,
-                    textdistance.jaro_winkler(
-                        addr2["prefix"] + " " + addr2["value"], addr1["value"]
-                    ),
-                )
-            adjustment_sec = 1 if not addr1["prefix"] and not addr2["prefix"] else 0.7
-            max_score_sec = max(
-                max_score_sec,
-                textdistance.jaro_winkler(addr1["value"], addr2["value"])
-                * adjustment_sec,
-            )
-        else:
-            if addr1["value"]:
-                max_score_sec = max(
-                    max_score_sec,
-                    textdistance.jaro_winkler(
-                        addr1["prefix"] + addr1["value"], addr2["prefix"]
-                    )
-                    * 0.6,
-                )
-                max_score_sec = max(
-                    max_score_sec,
-                    textdistance.jaro_winkler(addr1["value"], addr2["prefix"]) * 0.6,
-                )
-            if addr2["value"]:
-                max_score_sec = max(
-                    max_score_sec,
-                    textdistance.jaro_winkler(
-                        addr2["prefix"] + addr2["value"], addr1["prefix"]
-                    )
-                    * 0.6,
-                )
-                max_score_sec = max(
-                    max_score_sec,
-                    textdistance.jaro_winkler(addr2["value"], addr1["prefix"]) * 0.6,
-                )
-        max_score_sec = max(
+    has_secondary = (has_prefix1 & has_prefix2) | (has_value1 & has_value2)
+    both_values = has_value1 & has_value2
+    value_score = jaro_winkler(both_values, "value", "value")
+    both_prefixes = both_values & has_prefix1 & has_prefix2
+    max_score_sec = np.where(
+        both_prefixes,
+        value_score * 0.8 + jaro_winkler(both_prefixes, "prefix", "prefix") * 0.2,
+        0,
+    )
+    max_score_sec = np.maximum(
+        max_score_sec,
+        jaro_winkler(both_values & has_prefix1, "prefix_value", "value"),
+    )
+    max_score_sec = np.maximum(
+        max_score_sec,
+        jaro_winkler(both_values & has_prefix2, "prefix_value", "value", swap=True),
+    )
+    adjustment_sec = np.where(~has_prefix1 & ~has_prefix2, 1, 0.7)
+    max_score_sec = np.where(
+        both_values,
+        np.maximum(max_score_sec, value_score * adjustment_sec),
+        max_score_sec,
+    )
+
+    # a value on only one side (so both have a prefix)
+    value1_only = has_secondary & ~both_values & has_value1
+    value2_only = has_secondary & ~both_values & has_value2
+    for mask, swap in ((value1_only, False), (value2_only, True)):
+        max_score_sec = np.maximum(
             max_score_sec,
-            textdistance.jaro_winkler(
-                addr1["prefix"] + addr1["value"], addr2["prefix"] + addr2["value"]
-            )
-            * 0.8,
+            jaro_winkler(mask, "prefixvalue", "prefix", swap=swap) * 0.6,
+        )
+        max_score_sec = np.maximum(
+            max_score_sec, jaro_winkler(mask, "value", "prefix", swap=swap) * 0.6
         )
-        if max_score_sec:
-            secondary_score = max_score_sec
+
+    max_score_sec = np.maximum(
+        max_score_sec,
+        jaro_winkler(has_secondary, "prefixvalue", "prefixvalue") * 0.8,
+    )
+    secondary_score = max_score_sec
 
     # See if simple string compare of all things combined
     # with a 0.6 adjustment is better
-    score = max(
+    all_pairs = np.ones(len(score), dtype=bool)
+    address_score = jaro_winkler(
+        all_pairs, "household_street_address", "household_street_address"
+    )
+    score = np.maximum(
         score,
-        textdistance.jaro_winkler(a1, a2) * (weight_number + weight_street_name) * 0.6,
+        address_score * (weight_number + weight_street_name) * 0.6,
     ) + (secondary_score * weight_secondary)
     return score
 
 
-# https://github.com/J535D165/recordlinkage/blob/master/recordlinkage/compare.py
-class AddressComparison(BaseCompareFeature):
-    """Compare the record pairs as Addresses.
-    This class is used to compare records using custom address-based logic.
-    ----------
-    left_on : str or int
-        Field name to compare in left DataFrame.
-    right_on : str or int
-        Field name to compare in right DataFrame.
-    """
-
-    name = "address"
-    description = "Compare attributes of record pairs."
-
-    def __init__(self, left_on, right_on, label=None):
-        super(AddressComparison, self).__init__(left_on, right_on, label=label)
-
-    def _compute_vectorized(self, s1, s2):
-        # https://github.com/J535D165/recordlinkage/blob/5b3230f5cff92ef58968eedc451735e972035793/recordlinkage/algorithms/string.py
-        conc = pd.Series(list(zip(s1, s2)))
-
-        def comp_address_apply(x):
-            try:
-                return address_distance(x[0], x[1])
-            except Exception as err:
-                if pd.isnull(x[0]) or pd.isnull(x[1]):
-                    return np.nan
-                else:
-                    raise err
-
-        c = conc.apply(comp_address_apply)
-        return c
+def explode_addresses(pii_lines, workers=None, debug=False):
+    # break out each address into number, street, suffix, etc.
+    # addr_parse is relatively slow, so it only runs once per distinct address
+    # (household members usually share one) and is spread across a process pool.
+    # each part is added as a categorical column, indexed by the address's code,
+    # rather than a string object per row
+    address_column = (
+        pii_lines["household_street_address"]
+        .astype("category")
+        .cat.remove_unused_categories()
+    )
+    addresses = address_column.cat.categories.to_numpy(dtype=object)
+    workers = workers or os.cpu_count()
 
+    if debug:
+        print(
+            f"[{datetime.now()}] Parsing {len(addresses)} distinct addresses"
+            f" for {len(pii_lines)} rows"
+        )
 
-def explode_address(row):
-    # this addr_parse function is relatively slow so only run it once per row.
-    # by caching the exploded dict this way we ensure
-    #  that we have it in the right form in all the right places its needed
-    parsed = addr_parse(row.household_street_address)
-    parsed["exploded_address"] = parsed.copy()
-    parsed["exploded_address"][
-        "household_street_address"
-    ] = row.household_street_address
-    return parsed
+    if workers > 1 and len(addresses) >= MIN_ADDRESSES_FOR_POOL:
+        chunksize = max(len(addresses) // (workers * 4), 1)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = list(executor.map(addr_parse, addresses, chunksize=chunksize))
+    else:
+        parsed = [addr_parse(address) for address in addresses]
+
+    address_codes = address_column.cat.codes.to_numpy()
+    pii_lines_exploded = pii_lines.copy(deep=False)
+    for column in PARSED_COLUMNS:
+        # categories sorted like the strings, so sorting on the codes is the same
+        part_codes, parts = pd.factorize(
+            np.array([address[column] for address in parsed], dtype=object),
+            sort=True,
+        )
+        pii_lines_exploded[column] = pd.Categorical.from_codes(
+            part_codes[address_codes], categories=parts
+        )
+    return pii_lines_exploded
 
 
 def get_household_matches(
-    pii_lines, split_factor=4, debug=False, exact_addresses=False, pairsfile=None
+    pii_lines,
+    split_factor=None,
+    debug=False,
+    exact_addresses=False,
+    pairsfile=None,
+    workers=None,
+    pii_timestamp=None,
+    memory_budget=None,
+    block_cap=None,
+    address_lsh=False,
+    checkpoint=None,
+    telemetry=None,
 ):
+    # with a Telemetry, the metrics of each stage are recorded in it
+    if exact_addresses and not pairsfile:
+        # households are just the rows at each address, no pairs needed
+        with stage(telemetry, "exact_address_grouping", rows=len(pii_lines)):
+            labels = exact_address_households(pii_lines, debug)
+        if debug:
+            # not every pair in each household, just enough to rebuild them
+            dump_matching_pairs(component_pairs(labels), pii_timestamp, len(pii_lines))
+        return labels
+
     if pairsfile:
         if debug:
             print(f"[{datetime.now()}] Loading matching pairs file")
 
-        matching_pairs = pd.read_csv(pairsfile, index_col=[0, 1], header=None).index
-        gc.collect()
+        with stage(telemetry, "load_pairs") as metrics:
+            matching_pairs = read_pairs_file(pairsfile, pii_timestamp, len(pii_lines))
+            metrics["pairs"] = len(matching_pairs[0])
 
         if debug:
             print(f"[{datetime.now()}] Done loading matching pairs")
 
     else:
+        matching_pairs = find_matching_pairs(
+            pii_lines,
+            split_factor,
+            debug,
+            workers,
+            memory_budget=memory_budget,
+            block_cap=block_cap,
+            address_lsh=address_lsh,
+            checkpoint=checkpoint,
+            telemetry=telemetry,
+        )
+        if debug:
+            dump_matching_pairs(matching_pairs, pii_timestamp, len(pii_lines))
 
-        if exact_addresses:
-            pii_lines_exploded = pii_lines
-        else:
-            # break out the address into number, street, suffix, etc,
-            # so we can prefilter matches based on those
-            addr_cols = pii_lines.apply(
-                explode_address,
-                axis="columns",
-                result_type="expand",
-            )
-            pii_lines_exploded = pd.concat([pii_lines, addr_cols], axis="columns")
+    if debug:
+        print(f"[{datetime.now()}] Clustering matching pairs into households")
 
-        if debug:
-            print(f"[{datetime.now()}] Done pre-processing PII file")
+    # matching pairs are edges in a graph of pii_lines positions,
+    # each connected component of that graph is a household
+    with stage(
+        telemetry, "clustering", rows=len(pii_lines), pairs=len(matching_pairs[0])
+    ):
+        labels = connected_components(len(pii_lines), *matching_pairs)
 
-        candidate_links = get_candidate_links(
-            pii_lines_exploded, split_factor, exact_addresses, debug
-        )
-        gc.collect()
+    if debug:
+        print(f"[{datetime.now()}] Done clustering")
 
-        if exact_addresses:
-            # the candidate links are already all the pairs with matching [address, zip]
-            matching_pairs = candidate_links
-        else:
-            matching_pairs = get_matching_pairs(
-                pii_lines_exploded,
-                candidate_links,
-                split_factor,
-                exact_addresses,
-                debug,
-            )
-            del pii_lines_exploded
-            del candidate_links
-            gc.collect()
+    return labels
 
-        if debug:
-            timestamp = datetime.now().strftime(TIMESTAMP_FMT)
-            pairs_path = Path("temp-data") / f"households_pairs-{timestamp}.csv"
-            with open(
-                pairs_path,
-                "w",
-                newline="",
-                encoding="utf-8",
-            ) as pairs_csv:
-                print(f"[{datetime.now()}] Dumping matching pairs to file")
-                pairs_writer = csv.writer(pairs_csv)
-                for i in range(len(matching_pairs)):
-                    pairs_writer.writerow(matching_pairs[i])
-                print(f"[{datetime.now()}] Wrote matching pairs to {pairs_path}")
-
-    five_percent = max(int(len(matching_pairs) / 20), 1)
-    pos_to_pairs = {}
-    # note: "for pair in matching_pairs:" had unexpectedly poor performance here
-    for i in range(len(matching_pairs)):
-        pair = matching_pairs[i]
-        if debug and (i % five_percent) == 0:
-            print(
-                f"[{datetime.now()}] Building dict of matching pairs "
-                f"- {i}/{len(matching_pairs)}"
-            )
 
-        if pair[0] in pos_to_pairs:
-            pos_to_pairs[pair[0]].append(pair)
-        else:
-            pos_to_pairs[pair[0]] = [pair]
+def exact_address_households(pii_lines, debug=False):
+    """Household labels with --exact_addresses, from a single groupby on
+    the zip and address rather than pairing up every row at an address,
+    so the cost is linear in the number of rows, however big a household
+    or apartment building is. The labels are the same connected_components
+    gives for the candidate pairs of that block: the smallest position in
+    each household, with rows without an address in households of their own.
+    """
+    if debug:
+        print(f"[{datetime.now()}] Grouping rows by zip and address")
+
+    n_rows = len(pii_lines)
+    labels = np.arange(n_rows, dtype=position_dtype(n_rows))
+    # a missing address isn't a match ("" == ""), see get_candidate_links
+    has_address = (pii_lines.household_street_address != "").to_numpy()
+    rows = labels[has_address]
+    group_ids = block_groups(pii_lines[has_address], EXACT_ADDRESS_KEY)
+    rows, group_ids = rows[group_ids >= 0], group_ids[group_ids >= 0]
+
+    # rows are in position order, so assigning them backwards
+    # leaves each group with its first, smallest, position
+    first_rows = np.empty(group_ids.max() + 1 if len(group_ids) else 0, labels.dtype)
+    first_rows[group_ids[::-1]] = rows[::-1]
+    labels[rows] = first_rows[group_ids]
 
-        if pair[1] in pos_to_pairs:
-            pos_to_pairs[pair[1]].append(pair)
+    if debug:
+        print(
+            f"[{datetime.now()}] Found {len(first_rows)} addresses"
+            f" among {len(rows)} rows with an address"
+        )
+    return labels
+
+
+def find_matching_pairs(
+    pii_lines,
+    split_factor=None,
+    debug=False,
+    workers=None,
+    batch_size=None,
+    memory_budget=None,
+    block_cap=None,
+    address_lsh=False,
+    checkpoint=None,
+    telemetry=None,
+):
+    # every pair of pii_lines positions that belong in the same household.
+    # pairs are compared len(pii_lines) / split_factor at a time,
+    # or batch_size at a time, or if neither is given
+    # chunks of work are sized to fit the memory_budget.
+    # with a Checkpoint, each stage is saved as it completes,
+    # and stages it already has are loaded rather than run again
+    if split_factor is None and batch_size is None:
+        memory_budget = memory_budget or MemoryBudget()
+    else:
+        memory_budget = None
+
+    with stage(telemetry, "address_parsing", rows=len(pii_lines)) as metrics:
+        parsed = checkpoint.load_addresses() if checkpoint else None
+        metrics["from_checkpoint"] = parsed is not None
+        if parsed is not None:
+            pii_lines_exploded = pii_lines.join(parsed)
         else:
-            pos_to_pairs[pair[1]] = [pair]
+            # break out the address into number, street, suffix, etc,
+            # so we can prefilter matches based on those
+            pii_lines_exploded = explode_addresses(pii_lines, workers, debug)
+            if checkpoint:
+                checkpoint.save_addresses(pii_lines_exploded)
 
     if debug:
-        print(f"[{datetime.now()}] Done building dict")
+        print(f"[{datetime.now()}] Done pre-processing PII file")
 
-    return pos_to_pairs
+    with stage(telemetry, "blocking", rows=len(pii_lines)) as metrics:
+        candidate_links = checkpoint.load_candidates() if checkpoint else None
+        metrics["from_checkpoint"] = candidate_links is not None
+        if candidate_links is None:
+            candidate_links = get_candidate_links(
+                pii_lines_exploded,
+                debug,
+                memory_budget,
+                block_cap,
+                address_lsh,
+                telemetry,
+            )
+            if checkpoint:
+                checkpoint.save_candidates(candidate_links)
+        metrics["pairs"] = len(candidate_links[0])
+    gc.collect()
+
+    with stage(telemetry, "comparison", pairs=len(candidate_links[0])) as metrics:
+        matching_pairs = get_matching_pairs(
+            pii_lines_exploded,
+            candidate_links,
+            split_factor,
+            debug,
+            batch_size,
+            memory_budget,
+            checkpoint,
+        )
+        metrics["matches"] = len(matching_pairs[0])
+    del pii_lines_exploded
+    del candidate_links
+    gc.collect()
+    return matching_pairs
+
+
+def dump_matching_pairs(matching_pairs, pii_timestamp, n_rows):
+    # for debugging, and to skip matching in later runs with --pairsfile
+    timestamp = datetime.now().strftime(TIMESTAMP_FMT)
+    pairs_path = Path("temp-data") / f"households_pairs-{timestamp}{PAIRS_SUFFIX}"
+    print(f"[{datetime.now()}] Dumping matching pairs to file")
+    write_pairs_file(pairs_path, matching_pairs, pii_timestamp, n_rows)
+    print(f"[{datetime.now()}] Wrote matching pairs to {pairs_path}")
 
 
-def get_candidate_links(pii_lines, split_factor=4, exact_addresses=False, debug=False):
+def get_candidate_links(
+    pii_lines,
+    debug=False,
+    memory_budget=None,
+    block_cap=None,
+    address_lsh=False,
+    telemetry=None,
+):
+    # returns the candidate pairs as two arrays of pii_lines positions,
+    # (left, right) with left < right
     # indexing step defines the pairs of records for comparison
-    # indexer.full() does a full n^2 comparison, but we can do better
-    indexer = recordlinkage.Index()
-    # use block indexes to reduce the number of candidates
+    # a full n^2 comparison is far too slow, so use block indexes
+    # to reduce the number of candidates
     # while still retaining enough candidates to identify real households.
     # a block only on zip could work, but seems to run into memory issues
     # note sortedneighborhood on zip probably doesn't make sense
     # (zip codes in a geographic area will be too similar)
     # but if data is dirty then blocks may discard typos
 
-    if exact_addresses:
-        indexer.block(["household_zip", "household_street_address"])
-    else:
-        indexer.block(["household_zip", "street", "number"])
-        indexer.block(["household_zip", "family_name"])
-
-    # start with an empty index we can append to
-    candidate_links = pd.MultiIndex.from_tuples([], names=[0, 1])
+    # with a block_cap, groups too big to compare all against all
+    # are sorted on the block's sort key instead, and each row is only compared
+    # with its neighbours. eg. a common family name in a zip is sorted by address.
+    blocks = [
+        ["household_zip", "street", "number"],
+        ["household_zip", "family_name"],
+    ]
+    sort_keys = [
+        ["family_name", "phone_number"],
+        ["street", "number", "phone_number"],
+    ]
 
     # only include lines with an address, since otherwise
     #   missing addresses will be considered a match ("" == "")
     pii_lines_with_address = pii_lines[pii_lines.household_street_address != ""]
 
-    if len(pii_lines_with_address) == 0:
-        # essentially just a null check
-        # don't bother with the rest if we have no addresses
-        # this should never happen
-        return candidate_links
-
-    # break up the dataframe into subframes,
-    # and iterate over every pair of subframes.
-    # we improve performance somewhat by only comparing looking forward,
-    # that is, only comparing a given set of rows
-    # against rows with higher indices.
-    for subset_A in np.array_split(pii_lines_with_address, split_factor):
-        first_item_in_A = subset_A.index.min()
-
-        # don't compare against earlier items
-        # Note: this assumes that the index is the row number
-        # (NOT the record_id/patid) and the df is sequential
-        # this is currently the case in households.py#parse_source_file()
-        lines_to_compare = pii_lines_with_address[first_item_in_A:]
-
-        # pick a sub split factor to give us ~same size subset_A and subset_B.
-        # the idea is that there's some implicit overhead to splitting,
-        # so don't split more tha necessary
-        sub_split_factor = max(int(len(lines_to_compare) / len(subset_A)), 1)
-        for subset_B in np.array_split(lines_to_compare, sub_split_factor):
-            if debug:
-                print(
-                    f"[{datetime.now()}]  Indexing rows "
-                    f"[{subset_A.index.min()}..{subset_A.index.max()}]"
-                    " against "
-                    f"[{subset_B.index.min()}..{subset_B.index.max()}]"
-                    f". {len(candidate_links)} candidates so far"
-                )
-
-            # note pairs_subset and candidate_links are MultiIndexes
-            pairs_subset = indexer.index(subset_A, subset_B)
-
-            # now we have to remove duplicate and invalid pairs
-            # e.g. (1, 2) and (2, 1) should not both be in the list
-            #      and (1, 1) should not be in the list
-            # the simple approach is just take the items where a < b
-            # unfortunately we have to loop it through a dataframe.
-            # this is done on the subset rather than the entire list
-            # to make sure we don't potentially duplicate a massive list
-            # and crash with OOM
-            pairs_subset = pairs_subset.to_frame()
-            pairs_subset = pairs_subset[pairs_subset[0] < pairs_subset[1]]
-            pairs_subset = pd.MultiIndex.from_frame(pairs_subset)
-
-            candidate_links = candidate_links.append(pairs_subset)
-
-            gc.collect()
+    # rows are grouped on each block key and the pairs within each group
+    # are generated directly, looking forward only
+    # (ie. (1, 2) but not (2, 1) or (1, 1)).
+    # memory use is proportional to the number of candidate pairs,
+    # so there is no need to split the dataframe up here.
+    # Note: this assumes that the index is the row number
+    # (NOT the record_id/patid) and the df is sequential
+    # this is currently the case in households.py#parse_source_file()
+    groups = [block_groups(pii_lines_with_address, columns) for columns in blocks]
+    batch_size = PAIR_BATCH_SIZE
+    if memory_budget is not None:
+        # pairs are expanded in batches that fit what's left of the budget,
+        # but all the candidate pairs have to be held at once
+        batch_size = memory_budget.batch_size(
+            INDEX_BYTES_PER_PAIR, MIN_INDEX_BATCH, PAIR_BATCH_SIZE
+        )
+        estimated_pairs = estimate_pair_count(groups, block_cap)
+        if debug:
+            print(
+                f"[{datetime.now()}] Memory plan for blocking: up to"
+                f" {estimated_pairs} candidate pairs, expanded {batch_size} at a time"
+                f" ({memory_budget.summary()})"
+            )
+        if not memory_budget.fits(estimated_pairs * INDEX_BYTES_PER_PAIR):
+            print(
+                f"WARNING: up to {estimated_pairs} candidate pairs may not fit in"
+                f" the memory budget ({memory_budget.summary()})."
+                " Consider --partition_by_zip or --export_shards"
+            )
+    candidate_links = block_candidate_pairs(
+        pii_lines_with_address,
+        blocks,
+        len(pii_lines),
+        debug,
+        batch_size,
+        groups,
+        block_cap,
+        sort_keys,
+        telemetry,
+    )
+    if address_lsh:
+        # the street and number block misses typos in either,
+        # so add pairs in the same zip with similar addresses
+        with stage(
+            telemetry, "address_lsh", rows=len(pii_lines_with_address)
+        ) as metrics:
+            lsh_left, lsh_right = lsh_candidate_pairs(
+                pii_lines_with_address, len(pii_lines), debug
+            )
+            metrics["pairs"] = len(lsh_left)
+        candidate_links = dedupe_pairs(
+            [candidate_links[0], lsh_left],
+            [candidate_links[1], lsh_right],
+            len(pii_lines),
+            candidate_links[0].dtype,
+        )
 
     if debug:
-        print(f"[{datetime.now()}] Found {len(candidate_links)} candidate pairs")
+        print(f"[{datetime.now()}] Found {len(candidate_links[0])} candidate pairs")
 
     return candidate_links
 
 
-def get_matching_pairs(
-    pii_lines, candidate_links, split_factor, exact_addresses, debug
-):
-    # Comparison step performs the defined comparison algorithms
-    # against the candidate pairs
-    compare_cl = recordlinkage.Compare()
+def address_similarity(pii_lines, left, right, cache=None, address_encoding=None):
+    # similarity of the addresses of the pairs (left[i], right[i])
+    if address_encoding is not None:
+        return encoded_address_distance(address_encoding, left, right, cache)
+    return address_distance(
+        pii_lines.iloc[left][ADDRESS_COLUMNS],
+        pii_lines.iloc[right][ADDRESS_COLUMNS],
+        cache,
+    )
+
 
-    compare_cl.string(
-        "family_name", "family_name", method="jarowinkler", label="family_name"
+def match_pairs(
+    pii_lines,
+    left,
+    right,
+    cache=None,
+    address_encoding=None,
+    stage_counts=None,
+):
+    """Which of the pairs (left[i], right[i]) are household matches.
+    Rather than scoring every field of every pair, this is a cascade:
+      1. the address score, which has to clear ADDR_THRESHOLD on its own
+      2. an upper bound on the total score, from the address score and the
+         lengths of the names and phone numbers (jaro_winkler_upper_bound)
+      3. the same bound with the actual family name score
+      4. the full score, with the phone number score
+    each stage only scoring the pairs that survived the previous one.
+    A pair is only dropped when its bound can't reach MATCH_THRESHOLD,
+    so the matches are exactly the ones scoring every field would find.
+    stage_counts, if given, is a dict accumulating the pairs dropped per stage
+    """
+    # NOTE: zip code is DISABLED because our indexes block on zip code
+    family_names = pii_lines["family_name"].to_numpy()
+    phone_numbers = pii_lines["phone_number"].to_numpy()
+    counts = {}
+    matches = np.zeros(len(left), dtype=bool)
+
+    addr = address_similarity(pii_lines, left, right, cache, address_encoding)
+    rows = np.flatnonzero(addr > ADDR_THRESHOLD)
+    counts["address"] = len(left) - len(rows)
+    addr = addr[rows]
+
+    fn_bound = jaro_winkler_upper_bound(
+        family_names[left[rows]], family_names[right[rows]]
     )
-    compare_cl.string(
-        "phone_number", "phone_number", method="jarowinkler", label="phone_number"
+    phone_bound = jaro_winkler_upper_bound(
+        phone_numbers[left[rows]], phone_numbers[right[rows]]
     )
-    if exact_addresses:
-        compare_cl.string(
-            "household_street_address",
-            "household_street_address",
-            method="jarowinkler",
-            label="household_street_address",
-        )
-    else:
-        compare_cl.add(
-            AddressComparison(
-                "exploded_address",
-                "exploded_address",
-                label="household_street_address",
-            )
-        )
+    keep = _may_match(fn_bound, phone_bound, addr)
+    counts["length_bound"] = len(rows) - int(keep.sum())
+    rows, addr, phone_bound = rows[keep], addr[keep], phone_bound[keep]
+
+    fn = jaro_winkler(family_names[left[rows]], family_names[right[rows]])
+    keep = _may_match(fn, phone_bound, addr)
+    counts["family_name"] = len(rows) - int(keep.sum())
+    rows, addr, fn = rows[keep], addr[keep], fn[keep]
+
+    phone = jaro_winkler(phone_numbers[left[rows]], phone_numbers[right[rows]])
+    # filter the matches down based on the cumulative score
+    score = (
+        fn * FN_WEIGHT
+        + phone * PHONE_WEIGHT
+        + addr * ADDR_WEIGHT
+        # + hamming_similarity(zips[left[rows]], zips[right[rows]]) * ZIP_WEIGHT
+    )
+    matched = score > MATCH_THRESHOLD
+    counts["score"] = len(rows) - int(matched.sum())
+    matches[rows[matched]] = True
+
+    if stage_counts is not None:
+        for cascade_stage, count in counts.items():
+            stage_counts[cascade_stage] = stage_counts.get(cascade_stage, 0) + count
+    return matches
+
+
+def _may_match(fn, phone, addr):
+    # whether scores (or upper bounds on them) could clear MATCH_THRESHOLD.
+    bound = fn * FN_WEIGHT + phone * PHONE_WEIGHT + addr * ADDR_WEIGHT
+    return bound > MATCH_THRESHOLD - BOUND_MARGIN
 
-    # NOTE: zip code is DISABLED because our indexes block on zip code
-    # compare_cl.string(
-    #     "household_zip", "household_zip", method="levenshtein", label="household_zip"
-    # )
-    # note: hamming distance is not implemented in this library,
-    # but levenshtein is. the two metrics are likely similar enough
-    # that it's not worth implementing hamming again
+
+def get_matching_pairs(
+    pii_lines,
+    candidate_links,
+    split_factor,
+    debug,
+    batch_size=None,
+    memory_budget=None,
+    checkpoint=None,
+):
+    # Comparison step performs the defined comparison algorithms
+    # against the candidate pairs.
+    # candidate_links and the returned matching pairs are both
+    # (left, right) arrays of pii_lines positions
+    # Note: this assumes that the index is the row number, as in get_candidate_links
+    # with a Checkpoint, the matches of each batch are saved,
+    # and comparing starts after the batches it already has
 
     if debug:
         print(f"[{datetime.now()}] Starting detailed comparison of indexed pairs")
 
-    # start with an empty index we can append to
-    matching_pairs = pd.MultiIndex.from_tuples([], names=[0, 1])
-    # we know that we could support len(subset_A) in memory above,
-    # so use the same amount here
-    len_subset_A = max(int(len(pii_lines) / split_factor), 1)
+    candidate_left, candidate_right = candidate_links
+    dtype = candidate_left.dtype
+    # matches from each batch are collected as arrays and concatenated once
+    # at the end
+    matching_left = []
+    matching_right = []
+    i = 0
+    if checkpoint:
+        matching_left, matching_right, i = checkpoint.load_matches()
+    n_matching = sum(len(left) for left in matching_left)
+    # the same address components come up in many batches
+    cache = SimilarityCache()
+    # pairs dropped at each stage of match_pairs
+    stage_counts = {}
+    address_encoding = AddressEncoding(pii_lines, candidate_links, debug)
+    # compare len(pii_lines) / split_factor candidate pairs at a time,
+    # unless given a batch_size (eg. for part of a larger file),
+    # or with a memory_budget, as many as fit in what's left of it
+    # as each batch starts
+    if memory_budget is None:
+        len_subset_A = batch_size or max(int(len(pii_lines) / split_factor), 1)
+    elif debug:
+        first_batch = memory_budget.batch_size(
+            COMPARE_BYTES_PER_PAIR, MIN_COMPARE_BATCH, MAX_COMPARE_BATCH
+        )
+        print(
+            f"[{datetime.now()}] Memory plan for comparison:"
+            f" {len(candidate_left)} candidate pairs, up to {first_batch} at a time"
+            f" ({memory_budget.summary()})"
+        )
 
     # note: np.array_split had unexpectedly poor performance here for very large indices
-    for i in range(0, len(candidate_links), len_subset_A):
-        subset_links = candidate_links[i : i + len_subset_A]
-
-        # filtering the relevant pii lines before passing into compute() below
-        #  seems to have a small positive impact on performance.
-        # subset_links is a MultiIndex so get the unique values from each level
-        #  to get the overall relevant pii lines for this iteration
-        keys = set(subset_links.get_level_values(0)) | set(
-            subset_links.get_level_values(1)
-        )
-        relevant_pii_lines = pii_lines[pii_lines.index.isin(keys)]
+    while i < len(candidate_left):
+        if memory_budget is not None:
+            len_subset_A = memory_budget.batch_size(
+                COMPARE_BYTES_PER_PAIR, MIN_COMPARE_BATCH, MAX_COMPARE_BATCH
+            )
+        subset_left = candidate_left[i : i + len_subset_A]
+        subset_right = candidate_right[i : i + len_subset_A]
         if debug:
             print(
                 f"[{datetime.now()}]  Detailed comparing rows "
                 f"[{i}..{i + len_subset_A}]"
             )
 
-        features = compare_cl.compute(subset_links, relevant_pii_lines)
-
-        # first filter by address similarity
-        features = features[features["household_street_address"] > ADDR_THRESHOLD]
-
-        features["family_name"] *= FN_WEIGHT
-        features["phone_number"] *= PHONE_WEIGHT
-        features["household_street_address"] *= ADDR_WEIGHT
-        # features["household_zip"] *= ZIP_WEIGHT
-
-        # filter the matches down based on the cumulative score
-        matches = features[features.sum(axis=1) > MATCH_THRESHOLD]
+        matches = match_pairs(
+            pii_lines,
+            subset_left,
+            subset_right,
+            cache,
+            address_encoding,
+            stage_counts,
+        )
 
-        matching_pairs = matching_pairs.append(matches.index)
+        matching_left.append(subset_left[matches].astype(dtype))
+        matching_right.append(subset_right[matches].astype(dtype))
+        n_matching += int(matches.sum())
+        if checkpoint:
+            checkpoint.save_matches(
+                i, i + len(subset_left), (matching_left[-1], matching_right[-1])
+            )
         # matching pairs are bi-directional and not duplicated,
         # ex if (1,9) is in the list then (9,1) won't be
 
         if debug:
-            print(f"[{datetime.now()}]  {len(matching_pairs)} matching pairs so far")
+            print(f"[{datetime.now()}]  {n_matching} matching pairs so far")
 
-        del features
         del matches
         gc.collect()
+        i += len_subset_A
 
     if debug:
-        print(f"[{datetime.now()}] Found {len(matching_pairs)} matching pairs")
+        print(f"[{datetime.now()}] Found {n_matching} matching pairs")
+        print(
+            f"[{datetime.now()}] Of {len(candidate_left)} candidate pairs,"
+            f" {stage_counts.get('address', 0)} were dropped by address score,"
+            f" {stage_counts.get('length_bound', 0)} by the name/phone length bound,"
+            f" {stage_counts.get('family_name', 0)} after the family name score"
+            f" and {stage_counts.get('score', 0)} by the full score"
+        )
+        print(f"[{datetime.now()}] {cache.summary()}")
 
-    return matching_pairs
+    return (
+        np.concatenate(matching_left) if matching_left else candidate_left[:0],
+        np.concatenate(matching_right) if matching_right else candidate_right[:0],
+    )
@@ -0,0 +1,138 @@
+import argparse
+import os
+import re
+import resource
+import sys
+
+# rough peak memory per candidate pair, measured on a 30k row file:
+# blocking peaks at ~34 bytes per pair (the pairs of each block, and the
+# pair codes to dedupe them), comparing at ~140 bytes per pair in a batch
+# on top of the address encoding and similarity cache, which are already
+# resident (so already counted) when each batch is sized
+INDEX_BYTES_PER_PAIR = 40
+COMPARE_BYTES_PER_PAIR = 200
+# comparing more pairs at once than this doesn't go any faster
+MAX_COMPARE_BATCH = 1_000_000
+MIN_COMPARE_BATCH = 10_000
+MIN_INDEX_BATCH = 100_000
+# without --max_memory, use this share of the memory available at the start
+DEFAULT_MEMORY_FRACTION = 0.5
+# or this much if the available memory can't be found out
+FALLBACK_MEMORY_BUDGET = 4 * 1024**3
+# only plan to use this much of what's left, the per pair costs are estimates
+HEADROOM = 0.8
+
+MEMORY_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_memory_size(size):
+    # "4G", "512M", "1.5G" or a number of bytes, for argparse
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", size.upper())
+    if not match:
+        raise argparse.ArgumentTypeError(
+            f"invalid memory size: {size!r}, expected eg. 512M or 4G"
+        )
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+
+def format_memory_size(n_bytes):
+    return f"{n_bytes / 1024**2:.0f}MB"
+
+
+def available_memory():
+    # memory available to start new work without swapping, or None if unknown
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def process_memory():
+    # resident memory of this process, or 0 if unknown
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def peak_process_memory():
+    # the most resident memory this process has held since the last
+    # reset_peak_memory(), or since it started where that isn't supported
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # in bytes on macOS, KB elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def peak_worker_memory():
+    # the most resident memory any finished child process of this one
+    # (eg. a process pool worker) held, or 0 if there haven't been any
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_memory():
+    # start peak_process_memory() again from the current resident memory (Linux)
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+class MemoryBudget:
+    """How much memory household inference may use, which chunks of work
+    (blocking, and batches of pairs to compare) are sized to fit.
+    Each chunk is sized when it starts, from what's left of the budget
+    given the memory this process already holds, and never more than
+    the memory the system has available at that point.
+    """
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            available = available_memory()
+            max_bytes = (
+                int(available * DEFAULT_MEMORY_FRACTION)
+                if available
+                else FALLBACK_MEMORY_BUDGET
+            )
+        self.max_bytes = max_bytes
+
+    def split(self, parts):
+        # an equal share of this budget, eg. for each of several processes
+        return MemoryBudget(self.max_bytes // max(parts, 1))
+
+    def free(self):
+        free = self.max_bytes - process_memory()
+        available = available_memory()
+        if available is not None:
+            free = min(free, available)
+        return max(free, 0)
+
+    def fits(self, n_bytes):
+        return n_bytes <= self.free() * HEADROOM
+
+    def batch_size(self, bytes_per_item, minimum, maximum):
+        # how many items fit in what's left of the budget, within [minimum, maximum]
+        fit = int(self.free() * HEADROOM / bytes_per_item)
+        return min(max(fit, minimum), maximum)
+
+    def summary(self):
+        return (
+            f"budget {format_memory_size(self.max_bytes)},"
+            f" {format_memory_size(process_memory())} in use"
+        )
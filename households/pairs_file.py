@@ -0,0 +1,86 @@
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+from households.blocking import position_dtype
+
+# binary matching pairs file:
+#   PAIRS_MAGIC
+#   one line of JSON header, padded with spaces so the array is aligned
+#   the pairs as a C-order (n, 2) array of row positions
+PAIRS_MAGIC = b"HOUSEHOLD-PAIRS 1\n"
+PAIRS_SUFFIX = ".pairs"
+HEADER_ALIGNMENT = 64
+# pairs written per chunk, so the (n, 2) array is never built in full
+WRITE_CHUNK_SIZE = 10_000_000
+
+
+def write_pairs_file(path, matching_pairs, pii_timestamp, n_rows):
+    left, right = matching_pairs
+    header = {
+        "pii_timestamp": pii_timestamp,
+        "pii_rows": n_rows,
+        "pairs": len(left),
+        "dtype": left.dtype.str,
+    }
+    header_json = json.dumps(header).encode("ascii")
+    header_len = len(PAIRS_MAGIC) + len(header_json) + 1
+    padding = -header_len % HEADER_ALIGNMENT
+    with open(path, "wb") as pairs_file:
+        pairs_file.write(PAIRS_MAGIC)
+        pairs_file.write(header_json + b" " * padding + b"\n")
+        for i in range(0, len(left), WRITE_CHUNK_SIZE):
+            chunk = np.column_stack(
+                (left[i : i + WRITE_CHUNK_SIZE], right[i : i + WRITE_CHUNK_SIZE])
+            )
+            chunk.tofile(pairs_file)
+
+
+def read_pairs_file(path, pii_timestamp, n_rows):
+    """Memory-map a matching pairs file as (left, right) arrays,
+    after checking it was made from the same PII file.
+    CSV files from older debug dumps are also accepted, but can't be checked.
+    """
+    with open(path, "rb") as pairs_file:
+        magic = pairs_file.read(len(PAIRS_MAGIC))
+        if magic != PAIRS_MAGIC:
+            print(
+                f"WARNING: {path} is not a binary pairs file, reading it as CSV."
+                " Unable to check it matches the PII file"
+            )
+            return read_pairs_csv(path, n_rows)
+        header = json.loads(pairs_file.readline())
+        offset = pairs_file.tell()
+
+    if header["pii_timestamp"] != pii_timestamp:
+        sys.exit(
+            f"Matching pairs file {path} was created from the PII file with"
+            f" timestamp {header['pii_timestamp']}, not {pii_timestamp}"
+        )
+    if header["pii_rows"] != n_rows:
+        sys.exit(
+            f"Matching pairs file {path} was created from {header['pii_rows']}"
+            f" PII rows, but the PII file has {n_rows}"
+        )
+    if header["pairs"] == 0:
+        empty = np.zeros(0, dtype=header["dtype"])
+        return empty, empty
+
+    pairs = np.memmap(
+        path,
+        dtype=header["dtype"],
+        mode="r",
+        offset=offset,
+        shape=(header["pairs"], 2),
+    )
+    return pairs[:, 0], pairs[:, 1]
+
+
+def read_pairs_csv(path, n_rows):
+    pairs = pd.read_csv(path, header=None, dtype=np.int64).to_numpy()
+    if len(pairs) and pairs.max() >= n_rows:
+        sys.exit(f"Matching pairs file {path} refers to rows not in the PII file")
+    dtype = position_dtype(n_rows)
+    return pairs[:, 0].astype(dtype), pairs[:, 1].astype(dtype)
@@ -0,0 +1,233 @@
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import starmap
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pandas as pd
+
+from households.blocking import position_dtype
+from households.clustering import component_pairs, connected_components
+from households.matching import exact_address_households, find_matching_pairs
+from households.memory import MemoryBudget
+
+# the columns household inference reads from pii_lines
+INFERENCE_COLUMNS = [
+    "family_name",
+    "phone_number",
+    "household_street_address",
+    "household_zip",
+]
+# zips are packed into this many work units per worker,
+# so a worker that finishes early can pick up another unit
+UNITS_PER_WORKER = 4
+
+
+def zip_work_units(zips, n_units):
+    """Assign every row to one of (at most) n_units work units,
+    keeping each zip code in a single unit. Every blocking key includes
+    the zip, so no candidate pair (and no household) spans two units.
+    Zips are packed largest first onto the unit with the fewest rows so far
+    """
+    zip_ids, distinct_zips = pd.factorize(zips)
+    rows_per_zip = np.bincount(zip_ids, minlength=len(distinct_zips))
+    n_units = max(min(n_units, len(distinct_zips)), 1)
+
+    unit_of_zip = np.zeros(len(distinct_zips), dtype=np.int64)
+    units = [(0, unit) for unit in range(n_units)]
+    for z in np.argsort(-rows_per_zip, kind="stable"):
+        rows, unit = heapq.heappop(units)
+        unit_of_zip[z] = unit
+        heapq.heappush(units, (rows + rows_per_zip[z], unit))
+    return unit_of_zip[zip_ids]
+
+
+class SharedFrame:
+    """String columns of a DataFrame in shared memory, so worker processes
+    can read any range of rows without the frame being pickled to them.
+    Each column is two shared blocks: its values UTF-8 encoded and
+    concatenated, and the offset each value starts at.
+    The process that creates a SharedFrame must unlink() it,
+    workers only ever see its layout (the names of the blocks)
+    """
+
+    def __init__(self, df, columns):
+        self.blocks = []
+        self.layout = {}
+        for column in columns:
+            encoded = [value.encode("utf-8") for value in df[column].to_numpy()]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+            data = self._share(b"".join(encoded))
+            shared_offsets = self._share(offsets.tobytes())
+            self.layout[column] = (data.name, shared_offsets.name, len(df))
+
+    def _share(self, buffer):
+        # SharedMemory can't be empty
+        block = SharedMemory(create=True, size=max(len(buffer), 1))
+        block.buf[: len(buffer)] = buffer
+        self.blocks.append(block)
+        return block
+
+    def unlink(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def read_shared_rows(layout, start, stop):
+    # rows [start, stop) of a SharedFrame as a DataFrame indexed from 0
+    columns = {}
+    for column, (data_name, offsets_name, n_rows) in layout.items():
+        data = SharedMemory(name=data_name)
+        shared_offsets = SharedMemory(name=offsets_name)
+        try:
+            offsets = np.ndarray(n_rows + 1, dtype=np.int64, buffer=shared_offsets.buf)[
+                start : stop + 1
+            ].tolist()
+            buf = data.buf
+            columns[column] = [
+                bytes(buf[offsets[i] : offsets[i + 1]]).decode("utf-8")
+                for i in range(stop - start)
+            ]
+            del buf, offsets
+        finally:
+            data.close()
+            shared_offsets.close()
+    return pd.DataFrame(columns)
+
+
+def infer_unit(
+    layout,
+    start,
+    stop,
+    batch_size,
+    memory_budget,
+    block_cap,
+    address_lsh,
+    exact_addresses,
+    keep_pairs,
+):
+    """Household inference for one work unit, rows [start, stop) of a SharedFrame,
+    comparing candidate pairs batch_size at a time,
+    or if that's None, as many as fit in the memory_budget.
+    Returns the unit's component labels and matching pairs (only if keep_pairs),
+    both as positions within the unit
+    """
+    unit_lines = read_shared_rows(layout, start, stop)
+    if exact_addresses:
+        labels = exact_address_households(unit_lines)
+        return labels, (component_pairs(labels) if keep_pairs else None)
+
+    # units are already spread across processes, so parse addresses in this one
+    matching_pairs = find_matching_pairs(
+        unit_lines,
+        debug=False,
+        workers=1,
+        batch_size=batch_size,
+        memory_budget=memory_budget,
+        block_cap=block_cap,
+        address_lsh=address_lsh,
+    )
+    labels = connected_components(len(unit_lines), *matching_pairs)
+    return labels, (matching_pairs if keep_pairs else None)
+
+
+def get_partitioned_household_matches(
+    pii_lines,
+    split_factor=None,
+    debug=False,
+    exact_addresses=False,
+    workers=None,
+    memory_budget=None,
+    block_cap=None,
+    address_lsh=False,
+):
+    """The same households as get_household_matches, inferred separately
+    for work units of whole zip codes, spread across a process pool.
+    Returns (labels, matching_pairs) in pii_lines positions, where matching_pairs
+    is None unless debug is set.
+    Labels are the smallest position in each household, as from
+    connected_components: rows keep their relative order within a unit,
+    so the unit's smallest position maps to the smallest global position
+    """
+    workers = workers or os.cpu_count()
+    n_rows = len(pii_lines)
+    dtype = position_dtype(n_rows)
+    if n_rows == 0:
+        empty = np.zeros(0, dtype=dtype)
+        return empty, ((empty, empty) if debug else None)
+
+    units = zip_work_units(pii_lines["household_zip"], workers * UNITS_PER_WORKER)
+    # lay the rows out unit by unit, so each unit is a contiguous range
+    order = np.argsort(units, kind="stable").astype(dtype)
+    bounds = np.searchsorted(units[order], np.arange(units.max() + 2))
+    ranges = [
+        (start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start
+    ]
+
+    if debug:
+        sizes = [stop - start for start, stop in ranges]
+        print(
+            f"[{datetime.now()}] Partitioned {n_rows} rows into {len(ranges)}"
+            f" work units of whole zip codes, {min(sizes)} to {max(sizes)} rows each,"
+            f" across {workers} workers"
+        )
+
+    labels = np.arange(n_rows, dtype=dtype)
+    frame = SharedFrame(pii_lines.iloc[order], INFERENCE_COLUMNS)
+    try:
+        # only the layout of the shared frame and a row range go to each worker.
+        # units compare as many pairs at a time as the whole file would,
+        # rather than splitting each (much smaller) unit split_factor ways.
+        # without a split_factor, each worker gets an equal share of the budget
+        if split_factor:
+            batch_size = max(int(n_rows / split_factor), 1)
+            unit_budget = None
+        else:
+            batch_size = None
+            unit_budget = (memory_budget or MemoryBudget()).split(workers)
+        tasks = [
+            (
+                frame.layout,
+                start,
+                stop,
+                batch_size,
+                unit_budget,
+                block_cap,
+                address_lsh,
+                exact_addresses,
+                debug,
+            )
+            for start, stop in ranges
+        ]
+        if workers > 1 and len(ranges) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(infer_unit, *zip(*tasks))
+                matching_pairs = _merge_units(results, ranges, order, labels)
+        else:
+            results = starmap(infer_unit, tasks)
+            matching_pairs = _merge_units(results, ranges, order, labels)
+    finally:
+        frame.unlink()
+
+    if debug:
+        print(f"[{datetime.now()}] Found {len(matching_pairs[0])} matching pairs")
+        return labels, matching_pairs
+    return labels, None
+
+
+def _merge_units(results, ranges, order, labels):
+    # map each unit's labels, and pairs if it kept them, to pii_lines positions
+    matching_left = [order[:0]]
+    matching_right = [order[:0]]
+    for (start, stop), (unit_labels, unit_pairs) in zip(ranges, results):
+        positions = order[start:stop]
+        labels[positions] = positions[unit_labels]
+        if unit_pairs is not None:
+            matching_left.append(positions[unit_pairs[0]])
+            matching_right.append(positions[unit_pairs[1]])
+    return np.concatenate(matching_left), np.concatenate(matching_right)
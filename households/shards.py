@@ -0,0 +1,259 @@
+import hashlib
+import json
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from households.blocking import position_dtype
+from households.clustering import connected_components
+from households.matching import exact_address_households, find_matching_pairs
+from households.partitioning import INFERENCE_COLUMNS, zip_work_units
+
+# a shard directory holds
+#   manifest.json                the PII file it was made from, and every shard
+#   shard-N.csv                  the rows of shard N, with their PII positions
+#   shard-N-households.csv       each row's household, once shard N is inferred
+#   shard-N-households.json      what shard N's households were inferred from
+MANIFEST_FILE = "manifest.json"
+POSITION_COLUMN = "pii_position"
+LABEL_COLUMN = "household_label"
+
+
+def shard_path(shard_dir, shard):
+    return Path(shard_dir) / f"shard-{shard}.csv"
+
+
+def shard_result_paths(shard_dir, shard):
+    shard_dir = Path(shard_dir)
+    return (
+        shard_dir / f"shard-{shard}-households.csv",
+        shard_dir / f"shard-{shard}-households.json",
+    )
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def export_shards(pii_lines, shard_dir, n_shards, pii_timestamp, debug=False):
+    """Split pii_lines into n_shards files of whole zip codes, which can each be
+    inferred on a different host with --shard, and write a manifest of them.
+    Households never span zip codes, so each shard's households are final.
+    """
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    units = zip_work_units(pii_lines["household_zip"], n_shards)
+
+    shards = []
+    for shard in range(units.max() + 1 if len(units) else 0):
+        positions = np.flatnonzero(units == shard)
+        path = shard_path(shard_dir, shard)
+        rows = pii_lines.iloc[positions][INFERENCE_COLUMNS]
+        rows.insert(0, POSITION_COLUMN, positions)
+        rows.to_csv(path, index=False)
+        shards.append(
+            {
+                "shard": shard,
+                "file": path.name,
+                "rows": len(positions),
+                "sha256": file_sha256(path),
+            }
+        )
+        if debug:
+            print(f"[{datetime.now()}]  Wrote {len(positions)} rows to {path}")
+
+    manifest = {
+        "pii_timestamp": pii_timestamp,
+        "pii_rows": len(pii_lines),
+        "created": datetime.now().isoformat(),
+        "shards": shards,
+    }
+    with open(shard_dir / MANIFEST_FILE, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    print(f"Exported {len(shards)} shards to {shard_dir}")
+
+
+def read_manifest(shard_dir):
+    manifest_path = Path(shard_dir) / MANIFEST_FILE
+    if not manifest_path.exists():
+        sys.exit(f"Unable to find shard manifest: {manifest_path}")
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def inference_settings(exact_addresses, block_cap, address_lsh):
+    # the settings that change which rows match, recorded with each shard's
+    # households so that shards inferred differently aren't merged together
+    return {
+        "exact_addresses": exact_addresses,
+        "address_lsh": address_lsh,
+        "max_block_size": block_cap.max_size if block_cap else None,
+        "block_window": block_cap.window if block_cap else None,
+    }
+
+
+def infer_shard(
+    shard_dir,
+    shard,
+    split_factor=None,
+    debug=False,
+    exact_addresses=False,
+    workers=None,
+    memory_budget=None,
+    block_cap=None,
+    address_lsh=False,
+):
+    """Infer the households of one exported shard, and write the household of
+    each of its rows next to it. Labels are PII positions, the smallest
+    in each household, the same as inferring the whole PII file would give
+    """
+    manifest = read_manifest(shard_dir)
+    if not 0 <= shard < len(manifest["shards"]):
+        sys.exit(f"Shard {shard} is not in {Path(shard_dir) / MANIFEST_FILE}")
+    entry = manifest["shards"][shard]
+    path = Path(shard_dir) / entry["file"]
+    if file_sha256(path) != entry["sha256"]:
+        sys.exit(f"Shard file {path} does not match the shard manifest")
+
+    if debug:
+        print(f"[{datetime.now()}] Loading shard {shard} from {path}")
+    # read the same way as the source PII file, see parse_source_file
+    rows = pd.read_csv(path, dtype=str, keep_default_na=False)
+    dtype = position_dtype(manifest["pii_rows"])
+    positions = pd.to_numeric(rows.pop(POSITION_COLUMN)).to_numpy(dtype=dtype)
+
+    if exact_addresses:
+        local_labels = exact_address_households(rows, debug)
+    else:
+        matching_pairs = find_matching_pairs(
+            rows,
+            split_factor,
+            debug,
+            workers,
+            memory_budget=memory_budget,
+            block_cap=block_cap,
+            address_lsh=address_lsh,
+        )
+        local_labels = connected_components(len(rows), *matching_pairs)
+    # shard rows are in PII position order,
+    # so the smallest local position is also the smallest PII position
+    labels = positions[local_labels]
+
+    labels_path, result_path = shard_result_paths(shard_dir, shard)
+    pd.DataFrame({POSITION_COLUMN: positions, LABEL_COLUMN: labels}).to_csv(
+        labels_path, index=False
+    )
+    result = {
+        "shard": shard,
+        "shard_sha256": entry["sha256"],
+        "rows": len(rows),
+        "households": int(len(np.unique(labels))),
+        "settings": inference_settings(exact_addresses, block_cap, address_lsh),
+        "sha256": file_sha256(labels_path),
+    }
+    with open(result_path, "w") as result_file:
+        json.dump(result, result_file, indent=2)
+
+    print(
+        f"Inferred {result['households']} households for the {len(rows)} rows"
+        f" of shard {shard}, written to {labels_path}"
+    )
+
+
+def merge_shards(shard_dir, pii_timestamp, n_rows, debug=False):
+    """Household labels for every PII row, from the inferred shards
+    in shard_dir. Checks every shard has been inferred from the exported rows,
+    and that every PII row is assigned to exactly one household
+    """
+    manifest = read_manifest(shard_dir)
+    if manifest["pii_timestamp"] != pii_timestamp:
+        sys.exit(
+            f"Shards in {shard_dir} were exported from the PII file with"
+            f" timestamp {manifest['pii_timestamp']}, not {pii_timestamp}"
+        )
+    if manifest["pii_rows"] != n_rows:
+        sys.exit(
+            f"Shards in {shard_dir} were exported from {manifest['pii_rows']}"
+            f" PII rows, but the PII file has {n_rows}"
+        )
+
+    dtype = position_dtype(n_rows)
+    labels = np.full(n_rows, -1, dtype=dtype)
+    times_assigned = np.zeros(n_rows, dtype=np.int64)
+    # the settings each shard was inferred with
+    shard_settings = []
+    for entry in manifest["shards"]:
+        shard = entry["shard"]
+        labels_path, result_path = shard_result_paths(shard_dir, shard)
+        if not result_path.exists() or not labels_path.exists():
+            sys.exit(f"Shard {shard} has not been inferred yet: {labels_path}")
+        with open(result_path) as result_file:
+            result = json.load(result_file)
+        if result["shard_sha256"] != entry["sha256"]:
+            sys.exit(
+                f"{labels_path} was inferred from a different export of shard {shard}"
+            )
+        if result["sha256"] != file_sha256(labels_path):
+            sys.exit(f"{labels_path} has changed since shard {shard} was inferred")
+        if "settings" not in result:
+            sys.exit(
+                f"{result_path} doesn't record the settings shard {shard} was"
+                " inferred with, infer it again with --shard"
+            )
+        shard_settings.append(result["settings"])
+
+        shard_labels = pd.read_csv(labels_path, dtype=np.int64)
+        positions = shard_labels[POSITION_COLUMN].to_numpy()
+        if len(positions) != entry["rows"]:
+            sys.exit(
+                f"{labels_path} has {len(positions)} rows,"
+                f" but shard {shard} was exported with {entry['rows']}"
+            )
+        values = shard_labels[[POSITION_COLUMN, LABEL_COLUMN]].to_numpy()
+        if ((values < 0) | (values >= n_rows)).any():
+            sys.exit(f"{labels_path} refers to rows not in the PII file")
+        labels[positions] = shard_labels[LABEL_COLUMN].to_numpy()
+        np.add.at(times_assigned, positions, 1)
+        if debug:
+            print(
+                f"[{datetime.now()}]  Merged {result['households']} households"
+                f" from shard {shard}"
+            )
+
+    # the merge check
+    unassigned = np.count_nonzero(times_assigned == 0)
+    repeated = np.count_nonzero(times_assigned > 1)
+    if unassigned or repeated:
+        sys.exit(
+            f"Shards in {shard_dir} don't cover the PII file exactly once:"
+            f" {unassigned} rows have no household,"
+            f" {repeated} rows have more than one"
+        )
+    # every label is the position of a row in its own household
+    if not np.array_equal(labels[labels], labels):
+        sys.exit(f"Shards in {shard_dir} have inconsistent household labels")
+    mixed = sorted(
+        setting
+        for setting in {name for settings in shard_settings for name in settings}
+        if len({json.dumps(settings.get(setting)) for settings in shard_settings}) > 1
+    )
+    if mixed:
+        sys.exit(
+            f"Shards in {shard_dir} were inferred with different settings"
+            f" ({', '.join(mixed)}), infer them all with the same ones"
+        )
+
+    if debug:
+        print(
+            f"[{datetime.now()}] Merged {len(manifest['shards'])} shards,"
+            f" every one of the {n_rows} PII rows is in exactly one household"
+        )
+    return labels
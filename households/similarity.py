@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+from jellyfish import jaro_winkler_similarity
+
+# how many scores a SimilarityCache holds before dropping the oldest half
+SIMILARITY_CACHE_SIZE = 1_000_000
+
+
+def jaro_winkler(left, right):
+    """Jaro-Winkler similarity of each pair of strings (left[i], right[i]).
+    The per-pair work runs in jellyfish's compiled implementation,
+    which is what textdistance.jaro_winkler calls when jellyfish is installed.
+    Note two empty strings score 0 here,
+    where textdistance.jaro_winkler("", "") is 1
+    """
+    return np.fromiter(
+        map(jaro_winkler_similarity, left, right),
+        dtype=np.float64,
+        count=len(left),
+    )
+
+
+def hamming_similarity(left, right):
+    """Normalized Hamming similarity of each pair of strings (left[i], right[i]),
+    the same as textdistance.hamming.normalized_similarity:
+    1 - (number of differing positions) / (length of the longer string),
+    where every position past the end of the shorter string differs
+    """
+    if len(left) == 0:
+        return np.zeros(0, dtype=np.float64)
+    # fixed width unicode arrays are padded with NUL, so the padding
+    # past the end of a shorter string never equals a real character
+    left = np.asarray(left, dtype=str)
+    right = np.asarray(right, dtype=str)
+    width = max(left.dtype.itemsize, right.dtype.itemsize) // 4
+    left_codes = left.astype(f"U{width}").view(np.uint32).reshape(-1, width)
+    right_codes = right.astype(f"U{width}").view(np.uint32).reshape(-1, width)
+    distance = (left_codes != right_codes).sum(axis=1)
+    longest = np.maximum(np.char.str_len(left), np.char.str_len(right))
+    normalized = np.divide(
+        distance, longest, out=np.zeros(len(left), dtype=np.float64), where=longest > 0
+    )
+    return 1 - normalized
+
+
+def jaro_winkler_upper_bound(left, right):
+    """An upper bound on jaro_winkler(left[i], right[i]) from the lengths
+    of the strings alone: at most the length of the shorter string
+    can match, with no transpositions, and the common prefix the
+    Winkler adjustment rewards is at most 4 characters
+    """
+    left_lengths = pd.Series(left, dtype=object).str.len().to_numpy(np.float64)
+    right_lengths = pd.Series(right, dtype=object).str.len().to_numpy(np.float64)
+    shorter = np.minimum(left_lengths, right_lengths)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        jaro = (shorter / left_lengths + shorter / right_lengths + 1) / 3
+    bound = jaro + np.minimum(shorter, 4) * 0.1 * (1 - jaro)
+    # jaro_winkler is 0 if either string is empty
+    return np.where(shorter > 0, bound, 0.0)
+
+
+class SimilarityCache:
+    """Scores of pairs of strings that have already been compared,
+    for comparisons that come up over and over, eg. the addresses
+    of household members, or street names and suffixes within a zip code.
+    Shared across batches of pairs.
+    Every score cached must be symmetric, so pairs are stored unordered.
+    Once max_size scores are stored, the oldest half are dropped.
+    """
+
+    def __init__(self, max_size=SIMILARITY_CACHE_SIZE):
+        self.max_size = max_size
+        self.scores = {}
+        self.lookups = 0
+        self.hits = 0
+
+    def jaro_winkler(self, left, right):
+        left = np.asarray(left, dtype=object)
+        right = np.asarray(right, dtype=object)
+        return self.lookup(
+            "jaro_winkler",
+            left,
+            right,
+            lambda rows: jaro_winkler(left[rows], right[rows]),
+        )
+
+    def hamming_similarity(self, left, right):
+        left = np.asarray(left, dtype=object)
+        right = np.asarray(right, dtype=object)
+        return self.lookup(
+            "hamming_similarity",
+            left,
+            right,
+            lambda rows: hamming_similarity(left[rows], right[rows]),
+        )
+
+    def lookup(self, name, left, right, compute):
+        """Score each pair of strings (left[i], right[i]).
+        compute(rows) scores the pairs at the given positions,
+        and is only called for the first occurrence of each distinct pair
+        that isn't already cached under this name
+        """
+        n_pairs = len(left)
+        if n_pairs == 0:
+            return np.zeros(0, dtype=np.float64)
+
+        # find the distinct unordered pairs in this batch
+        codes, values = pd.factorize(np.concatenate((left, right)))
+        left_codes = codes[:n_pairs].astype(np.int64)
+        right_codes = codes[n_pairs:]
+        pair_codes = np.minimum(left_codes, right_codes) * len(values) + np.maximum(
+            left_codes, right_codes
+        )
+        inverse, distinct_codes = pd.factorize(pair_codes)
+        distinct = np.empty(len(distinct_codes), dtype=np.int64)
+        distinct[inverse[::-1]] = np.arange(n_pairs - 1, -1, -1)
+
+        keys = [
+            (a, b) if a <= b else (b, a)
+            for a, b in zip(left[distinct], right[distinct])
+        ]
+        scores = self.scores.setdefault(name, {})
+        distinct_scores = np.fromiter(
+            (scores.get(key, np.nan) for key in keys),
+            dtype=np.float64,
+            count=len(keys),
+        )
+        missing = np.flatnonzero(np.isnan(distinct_scores))
+        if len(missing):
+            computed = compute(distinct[missing])
+            distinct_scores[missing] = computed
+            self.store(scores, [keys[i] for i in missing], computed)
+
+        self.lookups += n_pairs
+        self.hits += n_pairs - len(missing)
+        return distinct_scores[inverse]
+
+    def store(self, scores, keys, computed):
+        keys = keys[: self.max_size]
+        if len(scores) + len(keys) > self.max_size:
+            # drop the oldest half, or more if that doesn't make enough room
+            kept = list(scores.items())
+            drop = max(len(kept) // 2, len(kept) + len(keys) - self.max_size)
+            scores.clear()
+            scores.update(kept[drop:])
+        scores.update(zip(keys, computed.tolist()))
+
+    def summary(self):
+        hit_rate = self.hits / self.lookups if self.lookups else 0.0
+        n_scores = sum(len(scores) for scores in self.scores.values())
+        return (
+            f"{self.hits} of {self.lookups} similarity lookups were cached"
+            f" ({hit_rate:.1%}), {n_scores} scores in the cache"
+        )
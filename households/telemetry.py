@@ -0,0 +1,133 @@
+import json
+import resource
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+import numpy as np
+
+from households.memory import (
+    format_memory_size,
+    peak_process_memory,
+    peak_worker_memory,
+    process_memory,
+    reset_peak_memory,
+)
+
+
+def cpu_time():
+    # user and system time of this process and its finished child processes,
+    # eg. the process pool that parses addresses
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+class Telemetry:
+    """Metrics of each stage of household inference, written to a JSON file
+    to track regressions and plan capacity across sites.
+    Every stage records its wall and CPU time, the peak resident memory of
+    this process during it, and whatever counts the stage adds (eg. rows,
+    pairs), with pairs per second where there are pairs.
+    Worker processes (eg. --partition_by_zip, or parsing addresses) aren't
+    in this process's peak, so a stage whose workers held more memory than
+    any before it also records peak_worker_rss_bytes, the most any one of
+    them held, and the whole run records the most any worker held.
+    Stages can be nested, eg. each blocking pass within blocking,
+    and an outer stage's peak memory includes its inner stages.
+    Only counts and timings are recorded, never PII.
+    """
+
+    def __init__(self, debug=False):
+        self.debug = debug
+        self.started = datetime.now()
+        self.stages = []
+        # the peak memory seen so far by each open stage, innermost last
+        self.open_peaks = []
+
+    @contextmanager
+    def stage(self, name, **metrics):
+        # yields a dict the stage can add its counts to
+        self._note_peak()
+        reset_peak_memory()
+        self.open_peaks.append(0)
+        record = {"stage": name, "depth": len(self.open_peaks) - 1}
+        self.stages.append(record)
+        wall_start = time.perf_counter()
+        cpu_start = cpu_time()
+        worker_peak_start = peak_worker_memory()
+        try:
+            yield metrics
+        finally:
+            wall = time.perf_counter() - wall_start
+            self._note_peak()
+            peak = self.open_peaks.pop()
+            if self.open_peaks:
+                self.open_peaks[-1] = max(self.open_peaks[-1], peak)
+            record.update(
+                wall_seconds=round(wall, 3),
+                cpu_seconds=round(cpu_time() - cpu_start, 3),
+                peak_rss_bytes=peak,
+                end_rss_bytes=process_memory(),
+                **metrics,
+            )
+            if "pairs" in metrics and wall > 0:
+                record["pairs_per_second"] = round(metrics["pairs"] / wall)
+            # only known when it is a new high, the peak of workers finished
+            # before this stage can't be told apart from those in it
+            worker_peak = peak_worker_memory()
+            if worker_peak > worker_peak_start:
+                record["peak_worker_rss_bytes"] = worker_peak
+            if self.debug:
+                workers = (
+                    f", workers peak {format_memory_size(worker_peak)}"
+                    if "peak_worker_rss_bytes" in record
+                    else ""
+                )
+                print(
+                    f"[{datetime.now()}] Stage {name}: {wall:.1f}s,"
+                    f" {record['cpu_seconds']:.1f}s CPU,"
+                    f" peak {format_memory_size(peak)}{workers}"
+                )
+
+    def _note_peak(self):
+        # the peak is about to be reset or read, so every open stage keeps it
+        if self.open_peaks:
+            peak = peak_process_memory()
+            self.open_peaks = [max(seen, peak) for seen in self.open_peaks]
+
+    def write(self, path, **summary):
+        metrics = {
+            "started": self.started.isoformat(),
+            "wall_seconds": round((datetime.now() - self.started).total_seconds(), 3),
+            "peak_worker_rss_bytes": peak_worker_memory(),
+            **summary,
+            "stages": self.stages,
+        }
+        with open(path, "w") as metrics_file:
+            json.dump(metrics, metrics_file, indent=2)
+
+
+def stage(telemetry, name, **metrics):
+    # telemetry.stage(), or a stage that isn't recorded without telemetry
+    if telemetry is None:
+        return nullcontext(metrics)
+    return telemetry.stage(name, **metrics)
+
+
+def household_size_distribution(labels):
+    # how many households there are of each size, given the household labels
+    # (positions in pii_lines) of every row
+    sizes = np.bincount(labels)
+    sizes = sizes[sizes > 0]
+    size_counts = np.bincount(sizes)
+    return {
+        "households": len(sizes),
+        "mean_size": round(float(sizes.mean()), 3) if len(sizes) else 0.0,
+        "max_size": int(sizes.max()) if len(sizes) else 0,
+        "size_counts": {
+            str(size): int(count) for size, count in enumerate(size_counts) if count
+        },
+    }
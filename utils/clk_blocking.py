@@ -0,0 +1,181 @@
+import json
+import os
+import random
+from collections import Counter, defaultdict
+from pathlib import Path
+from zipfile import ZipFile
+
+import numpy as np
+from blocklib.pprllambdafold import PPRLIndexLambdaFold
+
+from utils.clk_stats import clks_to_matrix
+
+# how many of the biggest blocks to list by key in the blocking report
+LARGEST_BLOCKS = 10
+# kept out of the output directory, where block.py looks for CLK files
+BLOCKING_REPORT = Path("temp-data") / "blocking_report.json"
+
+
+def is_incremental_schema(blocking_config):
+    # only lambda-fold over CLKs can be computed from the Bloom filters alone,
+    # p-sig needs the raw PII
+    return blocking_config.get("type") == "lambda-fold" and blocking_config.get(
+        "config", {}
+    ).get("input-clks", False)
+
+
+class LambdaFoldBlocker:
+    """Lambda-fold blocking computed batch by batch from in-memory CLKs.
+    Produces the same blocks, in the same order, as `anonlink block` does
+    when reading the CLK JSON file back in.
+    """
+
+    def __init__(self, blocking_config, bf_len):
+        self.blocking_config = blocking_config
+        self.state = PPRLIndexLambdaFold(blocking_config["config"])
+        # blocklib re-seeds the global random module and draws
+        # the sampled bit positions before looking at any records,
+        # so they can be drawn up front here in the same order
+        random.seed(self.state.random_state)
+        self.indices = [
+            random.sample(range(bf_len), self.state.K)
+            for _ in range(self.state.mylambda)
+        ]
+        self.tables = [defaultdict(list) for _ in range(self.state.mylambda)]
+        self.n_records = 0
+
+    def update(self, clks):
+        if not clks:
+            return
+        bits = np.unpackbits(clks_to_matrix(clks), axis=1)
+        rec_ids = range(self.n_records, self.n_records + len(clks))
+        for i, (indices, table) in enumerate(zip(self.indices, self.tables)):
+            # render each record's sampled bits as a string of '0' and '1'
+            block_bits = np.ascontiguousarray(bits[:, indices] + ord("0"))
+            block_keys = block_bits.view(f"S{self.state.K}").ravel()
+            prefix = str(i)
+            for rec_id, block_key in zip(rec_ids, block_keys):
+                table[prefix + block_key.decode("ascii")].append(rec_id)
+        self.n_records += len(clks)
+
+    def result(self):
+        """Build the same dict that `anonlink block` writes out"""
+        reversed_index = {}
+        for table in self.tables:
+            reversed_index.update(table)
+        self.state.set_blocking_features_index(self.state.blocking_features)
+        self.state.summarize_reversed_index(reversed_index)
+
+        encoding_to_blocks_map = defaultdict(list)
+        for block_key, rec_ids in reversed_index.items():
+            for rec_id in rec_ids:
+                encoding_to_blocks_map[rec_id].append(str(block_key))
+
+        block_state_vars = {}
+        for name in dir(self.state):
+            if (
+                "__" not in name
+                and not callable(getattr(self.state, name))
+                and name != "stats"
+            ):
+                block_state_vars[name] = getattr(self.state, name)
+
+        stats = dict(self.state.stats)
+        del stats["num_of_blocks_per_rec"]
+        return {
+            "blocks": encoding_to_blocks_map,
+            "meta": {
+                "state": block_state_vars,
+                "config": self.blocking_config,
+                "source": {"clk_count": [self.n_records]},
+                "stats": stats,
+            },
+        }
+
+
+def block_size_report(result):
+    """Summarize the block size distribution of one `anonlink block` result.
+    The linkage agent compares every pair of records that share a block,
+    so the number of comparisons it has to run grows with the square
+    of the block sizes.
+    """
+    block_sizes = Counter()
+    for block_keys in result["blocks"].values():
+        block_sizes.update(block_keys)
+    n_records = result["meta"]["source"]["clk_count"][0]
+    sizes = np.array(list(block_sizes.values()), dtype=np.int64)
+
+    # power of two buckets: [1, 2), [2, 4), [4, 8), ...
+    histogram = []
+    if len(sizes):
+        n_buckets = int(np.log2(sizes.max())) + 1
+        buckets = np.log2(sizes).astype(np.int64)
+        for b in range(n_buckets):
+            in_bucket = sizes[buckets == b]
+            histogram.append(
+                {
+                    "min_size": 2**b,
+                    "max_size": 2 ** (b + 1) - 1,
+                    "blocks": int(len(in_bucket)),
+                    "records": int(in_bucket.sum()),
+                }
+            )
+
+    # pairs a single data owner's records form inside blocks,
+    # and the comparisons the linkage agent would run against another
+    # data owner with the same block size distribution.
+    # records that share several blocks are counted once per block
+    pairs_within_blocks = int((sizes * (sizes - 1) // 2).sum())
+    estimated_comparisons = int((sizes * sizes).sum())
+    full_comparisons = n_records * n_records
+
+    return {
+        "number_of_records": n_records,
+        "number_of_blocks": int(len(sizes)),
+        "block_size": {
+            "min": int(sizes.min()) if len(sizes) else 0,
+            "max": int(sizes.max()) if len(sizes) else 0,
+            "mean": float(sizes.mean()) if len(sizes) else 0.0,
+            "median": float(np.median(sizes)) if len(sizes) else 0.0,
+            "p95": float(np.percentile(sizes, 95)) if len(sizes) else 0.0,
+            "p99": float(np.percentile(sizes, 99)) if len(sizes) else 0.0,
+        },
+        "block_size_histogram": histogram,
+        "largest_blocks": [
+            {"block_key": key, "size": size}
+            for key, size in block_sizes.most_common(LARGEST_BLOCKS)
+        ],
+        "pairs_within_blocks": pairs_within_blocks,
+        "estimated_comparisons": estimated_comparisons,
+        "full_comparisons": full_comparisons,
+        "reduction_ratio": (
+            1 - estimated_comparisons / full_comparisons if full_comparisons else 0.0
+        ),
+        "blocklib_stats": result["meta"]["stats"],
+    }
+
+
+def write_blocking_report(reports, blocking_config, report_path):
+    # reports is an iterable of (clk file name, block_size_report())
+    report = {"config": blocking_config, "schemas": dict(reports)}
+    Path(report_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(report_path, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    print("Blocking report written to " + str(report_path))
+
+
+def zip_blocked_files(blocked_files, zip_path):
+    # blocked_files is an iterable of (name in the zip, blocks json).
+    # the zip is written to a temp file next to it and only replaces zip_path
+    # once every blocked file is in it, so if blocking fails part way
+    # the last complete zip is left as it was
+    zip_path = Path(zip_path)
+    temp_path = zip_path.with_suffix(".tmp")
+    try:
+        with ZipFile(temp_path, "w") as garbled_zip:
+            for blocked_name, blocks_json in blocked_files:
+                garbled_zip.writestr(blocked_name, blocks_json)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    os.replace(temp_path, zip_path)
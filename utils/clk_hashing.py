@@ -0,0 +1,229 @@
+import csv
+import json
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+from pathlib import Path
+
+import clkhash
+from bitarray import bitarray
+from clkhash.bloomfilter import fold_xor, hashing_function_from_properties
+from clkhash.key_derivation import generate_key_lists
+from clkhash.serialization import serialize_bitarray
+from clkhash.validate_data import (
+    validate_entries,
+    validate_header,
+    validate_row_lengths,
+)
+
+# same chunking as clkhash, so memory use per worker is comparable
+CHUNK_SIZE = 10_000
+
+
+class SharedFeature:
+    """A feature definition used by one or more schemas.
+    Two schema fields share a SharedFeature when they read the same CSV column
+    with the same format, tokenization, hashing strategy, key and filter length,
+    so they always set exactly the same bits.
+    """
+
+    def __init__(self, column, field, key, hash_l):
+        self.column = column
+        self.field = field
+        self.key = key
+        self.hash_l = hash_l
+        self.comparator = field.hashing_properties.comparator
+        self.hash_function = hashing_function_from_properties(field.hashing_properties)
+
+    def encode(self, entry):
+        fhp = self.field.hashing_properties
+        ngrams = list(self.comparator.tokenize(self.field.format_value(entry)))
+        if not ngrams:
+            return None
+        return self.hash_function(
+            ngrams,
+            self.key,
+            fhp.strategy.bits_per_token(len(ngrams)),
+            self.hash_l,
+            fhp.encoding,
+        )
+
+
+class SchemaPlan:
+    """The shared features that make up one schema's CLKs"""
+
+    def __init__(self, name, schema, feature_ids):
+        self.name = name
+        self.schema = schema
+        self.feature_ids = feature_ids
+        self.hash_l = schema.l * 2**schema.xor_folds
+
+
+def load_schema(schema_path):
+    with open(schema_path, "r") as schema_fp:
+        schema_dict = json.load(schema_fp)
+    schema_dict = clkhash.schema.convert_to_latest_version(schema_dict)
+    return schema_dict, clkhash.schema.from_json_dict(schema_dict)
+
+
+def plan_schemas(schema_paths, secret):
+    """Work out which feature encodings can be shared between schemas.
+    Returns the list of distinct SharedFeatures and a SchemaPlan per schema
+    pointing into that list.
+    """
+    features = []
+    feature_index = {}
+    plans = []
+    for schema_path in schema_paths:
+        schema_dict, schema = load_schema(schema_path)
+        keys = generate_key_lists(
+            secret,
+            len(schema.fields),
+            key_size=schema.kdf_key_size,
+            salt=schema.kdf_salt,
+            info=schema.kdf_info,
+            kdf=schema.kdf_type,
+            hash_algo=schema.kdf_hash,
+        )
+        hash_l = schema.l * 2**schema.xor_folds
+        feature_ids = []
+        for column, (field, field_dict, key) in enumerate(
+            zip(schema.fields, schema_dict["features"], keys)
+        ):
+            if field.hashing_properties is None:
+                continue
+            signature = (
+                column,
+                json.dumps(field_dict, sort_keys=True),
+                tuple(key),
+                hash_l,
+            )
+            if signature not in feature_index:
+                feature_index[signature] = len(features)
+                features.append(SharedFeature(column, field, key, hash_l))
+            feature_ids.append(feature_index[signature])
+        plans.append(SchemaPlan(Path(schema_path).name, schema, feature_ids))
+    return features, plans
+
+
+def encode_chunk(features, plans, chunk, row_offset, validate=True):
+    """Hash one chunk of PII rows for every schema.
+    Each distinct feature is tokenized and hashed once,
+    then the per-feature filters are OR-ed together per schema.
+    """
+    for plan in plans:
+        validate_row_lengths(plan.schema.fields, chunk)
+        if validate:
+            validate_entries(plan.schema.fields, chunk, row_offset)
+
+    needed = sorted({f for plan in plans for f in plan.feature_ids})
+    encoded = {
+        f: [features[f].encode(row[features[f].column]) for row in chunk]
+        for f in needed
+    }
+
+    results = {}
+    for plan in plans:
+        clks = []
+        for i in range(len(chunk)):
+            bloomfilter = bitarray(plan.hash_l)
+            bloomfilter.setall(False)
+            for f in plan.feature_ids:
+                feature_filter = encoded[f][i]
+                if feature_filter is not None:
+                    bloomfilter |= feature_filter
+            clks.append(fold_xor(bloomfilter, plan.schema.xor_folds))
+        results[plan.name] = clks
+    return results
+
+
+_worker_state = {}
+
+
+def _init_worker(features, plans, validate):
+    _worker_state["args"] = (features, plans)
+    _worker_state["validate"] = validate
+
+
+def _encode_chunk_in_worker(chunk, row_offset):
+    features, plans = _worker_state["args"]
+    return encode_chunk(features, plans, chunk, row_offset, _worker_state["validate"])
+
+
+def read_chunks(reader, chunk_size):
+    row_offset = 0
+    while True:
+        chunk = tuple(tuple(row) for row in islice(reader, chunk_size))
+        if not chunk:
+            return
+        yield chunk, row_offset
+        row_offset += len(chunk)
+
+
+def generate_clks_for_schemas(
+    source_file, secret, schema_paths, validate=True, max_workers=None
+):
+    """Hash a PII CSV against several schemas in a single pass over the file.
+    Yields a dict of {schema file name: [bitarray, ...]} per chunk, in file order.
+    """
+    features, plans = plan_schemas(schema_paths, secret)
+
+    with open(source_file, "r", newline="", encoding="utf-8") as pii_fp:
+        reader = csv.reader(pii_fp)
+        column_names = next(reader)
+        for plan in plans:
+            validate_header(plan.schema.fields, column_names)
+
+        chunks = read_chunks(reader, CHUNK_SIZE)
+        first = next(chunks, None)
+        if first is None:
+            return
+        chunks = chain([first], chunks)
+        if max_workers == 1 or len(first[0]) < CHUNK_SIZE:
+            # a single chunk is not worth starting a process pool for
+            for chunk, row_offset in chunks:
+                yield encode_chunk(features, plans, chunk, row_offset, validate)
+            return
+
+        max_workers = max_workers or multiprocessing.cpu_count()
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(features, plans, validate),
+        ) as executor:
+            # only keep a bounded number of chunks in flight
+            # so the whole file is never held in memory at once
+            pending = deque()
+            for chunk, row_offset in chunks:
+                if len(pending) >= 2 * max_workers:
+                    yield pending.popleft().result()
+                pending.append(
+                    executor.submit(_encode_chunk_in_worker, chunk, row_offset)
+                )
+            while pending:
+                yield pending.popleft().result()
+
+
+class ClkJsonWriter:
+    """Streams CLKs to a file in the same format as `anonlink hash`,
+    i.e. json.dump({"clks": [...]}), without holding them all in memory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.fp = open(path, "w")
+        self.fp.write('{"clks": [')
+
+    def write(self, clks):
+        for clk in clks:
+            if self.count:
+                self.fp.write(", ")
+            # base64 output never needs JSON escaping
+            self.fp.write('"' + serialize_bitarray(clk) + '"')
+            self.count += 1
+
+    def close(self):
+        self.fp.write("]}")
+        self.fp.close()
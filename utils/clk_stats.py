@@ -0,0 +1,110 @@
+import base64
+import json
+
+import numpy as np
+
+# number of bits set in each possible byte value,
+# so popcounts can be computed with a single lookup over a byte matrix
+POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(
+    axis=1, dtype=np.uint8
+)
+HISTOGRAM_BINS = 20
+# a well-tuned Bloom filter sets roughly half of its bits.
+# filters much denser than this lose the ability to discriminate between records
+SATURATION_DENSITY = 0.6
+# process filters in batches so the unpacked bit matrix stays small
+STATS_CHUNK_SIZE = 4096
+# the sidecar for schema.json is schema-popcounts.json, next to the CLKs
+STATS_SUFFIX = "-popcounts.json"
+
+
+def clks_to_matrix(clks):
+    """Pack a list of bitarrays into an (n_records, n_bytes) uint8 matrix"""
+    if len(clks) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    n_bytes = len(clks[0].tobytes())
+    buffer = b"".join(clk.tobytes() for clk in clks)
+    return np.frombuffer(buffer, dtype=np.uint8).reshape(len(clks), n_bytes)
+
+
+class ClkStats:
+    """Running popcount and bit-density statistics for one schema's CLKs.
+    Call update() with each batch of Bloom filters as they are hashed,
+    then to_dict() to get the sidecar contents.
+    """
+
+    def __init__(self, schema_name, filter_length):
+        self.schema_name = schema_name
+        self.filter_length = filter_length
+        self.popcounts = []
+        self.bit_counts = np.zeros(filter_length, dtype=np.int64)
+
+    def update(self, clks):
+        for i in range(0, len(clks), STATS_CHUNK_SIZE):
+            matrix = clks_to_matrix(clks[i : i + STATS_CHUNK_SIZE])
+            if matrix.size == 0:
+                continue
+            self.popcounts.append(POPCOUNT_TABLE[matrix].sum(axis=1, dtype=np.uint16))
+            bits = np.unpackbits(matrix, axis=1)[:, : self.filter_length]
+            self.bit_counts += bits.sum(axis=0, dtype=np.int64)
+
+    def all_popcounts(self):
+        if not self.popcounts:
+            return np.zeros(0, dtype=np.uint16)
+        return np.concatenate(self.popcounts)
+
+    def to_dict(self):
+        popcounts = self.all_popcounts()
+        n_records = len(popcounts)
+        bin_edges = np.linspace(0, 1, HISTOGRAM_BINS + 1)
+
+        density = popcounts / self.filter_length
+        density_counts, _ = np.histogram(density, bins=bin_edges)
+
+        # fraction of records that set each bit position.
+        # bits that are set in (nearly) every record carry no information
+        bit_frequency = self.bit_counts / max(n_records, 1)
+        bit_counts, _ = np.histogram(bit_frequency, bins=bin_edges)
+
+        return {
+            "schema": self.schema_name,
+            "number_of_records": n_records,
+            "filter_length": self.filter_length,
+            # little-endian uint16, one per record, in the same order as the clks
+            "popcount_dtype": "<u2",
+            "popcounts": base64.b64encode(popcounts.astype("<u2").tobytes()).decode(
+                "ascii"
+            ),
+            "popcount_summary": {
+                "min": int(popcounts.min()) if n_records else 0,
+                "max": int(popcounts.max()) if n_records else 0,
+                "mean": float(popcounts.mean()) if n_records else 0.0,
+                "std": float(popcounts.std()) if n_records else 0.0,
+            },
+            "mean_density": float(density.mean()) if n_records else 0.0,
+            "density_histogram": {
+                "bin_edges": bin_edges.tolist(),
+                "counts": density_counts.tolist(),
+            },
+            "bit_frequency_histogram": {
+                "bin_edges": bin_edges.tolist(),
+                "counts": bit_counts.tolist(),
+            },
+        }
+
+    def is_saturated(self):
+        popcounts = self.all_popcounts()
+        if len(popcounts) == 0:
+            return False
+        return popcounts.mean() / self.filter_length > SATURATION_DENSITY
+
+
+def decode_popcounts(stats):
+    """Read the per-record popcounts back out of a sidecar dict"""
+    data = base64.b64decode(stats["popcounts"])
+    return np.frombuffer(data, dtype=np.dtype(stats["popcount_dtype"]))
+
+
+def write_clk_stats(clk_stats, path):
+    with open(path, "w") as stats_file:
+        json.dump(clk_stats.to_dict(), stats_file, indent=2)